@@ -1,22 +1,32 @@
+from bisect import bisect_left
 from collections import OrderedDict
+from functools import lru_cache
 
 from qgis.core import (
+    NULL,
     QgsFeature,
-    QgsFeatureSink,
+    QgsFeatureRequest,
     QgsField,
     QgsFields,
     QgsProcessing,
     QgsProcessingAlgorithm,
     QgsProcessingException,
+    QgsProcessingFeatureSourceDefinition,
+    QgsProcessingParameterBoolean,
     QgsProcessingParameterFeatureSink,
     QgsProcessingParameterFeatureSource,
     QgsProcessingParameterField,
     QgsProcessingParameterMatrix,
     QgsProcessingParameterEnum,
+    QgsProcessingParameterNumber,
+    QgsProviderConnectionException,
+    QgsProviderRegistry,
+    QgsVectorDataProvider,
 )
 from qgis.PyQt.QtCore import QVariant
 
 from . import domains
+from .sink_writer import ChunkedSinkWriter
 
 class ApplyMatrix(QgsProcessingAlgorithm):
 
@@ -25,6 +35,8 @@ class ApplyMatrix(QgsProcessingAlgorithm):
     INTENSITY_FIELD = "INTENSITY_FIELD"
     MATRIX = "MATRIX"
     PREDEFINED_MATRIX = "PREDEFINED_MATRIX"
+    CHUNK_SIZE = "CHUNK_SIZE"
+    IN_PLACE = "IN_PLACE"
     OUTPUT = "OUTPUT"
 
     PREDEFINED_MATRIX_CHOICES = list(
@@ -149,10 +161,33 @@ class ApplyMatrix(QgsProcessingAlgorithm):
 
 
         self.addParameter(
-            QgsProcessingParameterFeatureSink(self.OUTPUT, "Matrice applicata")
+            QgsProcessingParameterNumber(
+                self.CHUNK_SIZE,
+                "Numero di elementi scritti per blocco",
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                defaultValue=10000,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.IN_PLACE,
+                "Aggiorna solo gli attributi del layer di input, senza creare un nuovo layer",
+                defaultValue=False,
+            )
+        )
+
+        # Not written when the input layer is updated in place
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(self.OUTPUT, "Matrice applicata", optional=True)
         )
 
     def processAlgorithm(self, parameters, context, feedback):
+        # Set by the in place update for postProcessAlgorithm
+        self.in_place_layer = None
+        self.in_place_changes = None
+
         source = self.parameterAsSource(parameters, self.INPUT, context)
 
         if source is None:
@@ -160,25 +195,6 @@ class ApplyMatrix(QgsProcessingAlgorithm):
                 self.invalidSourceError(parameters, self.INPUT)
             )
 
-        fields = source.fields()
-        fields.append(QgsField("grado_pericolo", QVariant.Int))
-        fields.append(QgsField("matrice", QVariant.Int))
-
-        (sink, dest_id) = self.parameterAsSink(
-            parameters,
-            self.OUTPUT,
-            context,
-            fields,
-            source.wkbType(),
-            source.sourceCrs(),
-        )
-
-        # Send some information to the user
-        feedback.pushInfo(f"CRS is {source.sourceCrs().authid()}")
-
-        if sink is None:
-            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
-
         intensity_field = self.parameterAsFields(
             parameters,
             self.INTENSITY_FIELD,
@@ -213,7 +229,59 @@ class ApplyMatrix(QgsProcessingAlgorithm):
         processed_matrix = self.process_matrix_param(matrix)
         feedback.pushInfo(f"Processed matrix is {processed_matrix}")
 
-        new_features = []
+        chunk_size = self.parameterAsInt(parameters, self.CHUNK_SIZE, context)
+
+        if self.parameterAsBool(parameters, self.IN_PLACE, context):
+            layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+            if layer is None:
+                raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
+
+            # With "selected features only" just the selected features are updated, the source
+            # only returns those
+            input_definition = parameters[self.INPUT]
+            selected_only = False
+            if isinstance(input_definition, QgsProcessingFeatureSourceDefinition):
+                if input_definition.featureLimit != -1 or getattr(input_definition, "filterExpression", ""):
+                    raise QgsProcessingException(
+                        "L'aggiornamento del layer di input non supporta un limite di elementi o un filtro"
+                    )
+                selected_only = input_definition.selectedFeaturesOnly
+
+            self.check_in_place(layer)
+
+            # The project layer is only written and reloaded from the main thread, in postProcessAlgorithm
+            if not selected_only and self.apply_in_place_sql(
+                layer, processed_matrix, intensity_field, period_field, feedback
+            ):
+                self.in_place_layer = layer
+                return {self.OUTPUT: layer.id()}
+
+            changes = self.matrix_changes(source, processed_matrix, intensity_field, period_field, feedback)
+            if changes is not None:
+                self.in_place_layer = layer
+                self.in_place_changes = changes
+            return {self.OUTPUT: layer.id()}
+
+        fields = source.fields()
+        fields.append(QgsField("grado_pericolo", QVariant.Int))
+        fields.append(QgsField("matrice", QVariant.Int))
+
+        (sink, dest_id) = self.parameterAsSink(
+            parameters,
+            self.OUTPUT,
+            context,
+            fields,
+            source.wkbType(),
+            source.sourceCrs(),
+        )
+
+        # Send some information to the user
+        feedback.pushInfo(f"CRS is {source.sourceCrs().authid()}")
+
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+
+        writer = ChunkedSinkWriter(sink, chunk_size, feedback, source.featureCount())
 
         for feature in source.getFeatures():
             intensity = feature.attribute(intensity_field)
@@ -230,34 +298,173 @@ class ApplyMatrix(QgsProcessingAlgorithm):
 
             feature.setAttributes(attributes)
 
-            new_features.append(feature)
+            if not writer.addFeature(feature):
+                break
 
-        sink.addFeatures(new_features, QgsFeatureSink.FastInsert)
+        writer.flush()
         return {self.OUTPUT: dest_id}
 
-    def process_matrix_param(self, matrix):
-        """Return dict of dicts e.g. { intensity = { return_years = (matrix_value, danger), return_years = (matrix_value, danger}}"""
+    def postProcessAlgorithm(self, context, feedback):
+        if self.in_place_layer is not None:
+            if self.in_place_changes is not None:
+                self.apply_in_place(self.in_place_layer, self.in_place_changes)
+            self.in_place_layer.reload()
+            self.in_place_layer.updateFields()
+        return {}
+
+    def check_in_place(self, layer):
+        capabilities = layer.dataProvider().capabilities()
+        if not capabilities & QgsVectorDataProvider.ChangeAttributeValues:
+            raise QgsProcessingException(f"Il layer {layer.name()} non permette di modificare gli attributi")
+        if any(layer.fields().lookupField(name) == -1 for name in ("grado_pericolo", "matrice")):
+            if not capabilities & QgsVectorDataProvider.AddAttributes:
+                raise QgsProcessingException(f"Il layer {layer.name()} non permette di aggiungere campi")
+
+    def matrix_changes(self, source, processed_matrix, intensity_field, period_field, feedback):
+        """Return { feature id: (matrice, grado_pericolo) } for the features of source, reading no
+        geometry. Return None when canceled."""
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([intensity_field, period_field], source.fields())
+
+        total = source.featureCount()
+        changes = {}
+        for feature in source.getFeatures(request):
+            if feedback.isCanceled():
+                return None
+
+            changes[feature.id()] = self.get_matrix_value(
+                processed_matrix, feature.attribute(intensity_field), feature.attribute(period_field)
+            )
+            if total > 0:
+                feedback.setProgress(100.0 * len(changes) / total)
+
+        return changes
+
+    def apply_in_place(self, layer, changes):
+        """Write grado_pericolo and matrice straight into the input layer, without reading or
+        writing any geometry. Called from the main thread, with a single provider call so the
+        layer is either updated completely or not at all."""
+        provider = layer.dataProvider()
+        new_fields = [
+            QgsField(name, QVariant.Int)
+            for name in ("grado_pericolo", "matrice")
+            if provider.fields().lookupField(name) == -1
+        ]
+        if new_fields:
+            provider.addAttributes(new_fields)
+            layer.updateFields()
+
+        grado_pericolo_idx = provider.fields().lookupField("grado_pericolo")
+        matrice_idx = provider.fields().lookupField("matrice")
+        provider.changeAttributeValues(
+            {
+                fid: {grado_pericolo_idx: grado_pericolo, matrice_idx: matrice}
+                for fid, (matrice, grado_pericolo) in changes.items()
+            }
+        )
 
-        # Convert elements to int
-        for i in range(len(matrix)):
-            matrix[i] = int(matrix[i])
+    def apply_in_place_sql(self, layer, processed_matrix, intensity_field, period_field, feedback):
+        """Push the matrix down to a GeoPackage as a single UPDATE ... CASE statement, through a
+        connection of its own, adding the missing fields first.
+        Return False when the layer is not a plain GeoPackage table."""
+        if layer.providerType() != "ogr" or layer.subsetString():
+            return False
+
+        uri_parts = QgsProviderRegistry.instance().decodeUri("ogr", layer.source())
+        path = uri_parts.get("path", "")
+        table = uri_parts.get("layerName")
+        if not path.lower().endswith(".gpkg") or not table:
+            return False
+
+        try:
+            connection = QgsProviderRegistry.instance().providerMetadata("ogr").createConnection(path, {})
+            pairs = connection.executeSql(
+                "SELECT DISTINCT {}, {} FROM {}".format(
+                    quote_identifier(intensity_field), quote_identifier(period_field), quote_identifier(table)
+                )
+            )
+        except QgsProviderConnectionException as e:
+            feedback.pushInfo(f"Lettura SQL non riuscita ({e}), aggiornamento elemento per elemento")
+            return False
+
+        # The CASE would write NULL for values missing from the matrix, raise the same errors as the
+        # feature by feature update instead
+        for intensity, period in pairs:
+            self.get_matrix_value(processed_matrix, intensity, period)
+
+        if feedback.isCanceled():
+            return True
+
+        sql = 'UPDATE {} SET "grado_pericolo" = {}, "matrice" = {}'.format(
+            quote_identifier(table),
+            matrix_case_sql(processed_matrix, intensity_field, period_field, 1),
+            matrix_case_sql(processed_matrix, intensity_field, period_field, 0),
+        )
 
-        result = {}
-        for i in range(0, len(matrix), 4):
-            inner_dict = result.get(matrix[i], None)
+        try:
+            for name in ("grado_pericolo", "matrice"):
+                if layer.fields().lookupField(name) == -1:
+                    connection.addField(QgsField(name, QVariant.Int), "", table)
+            connection.executeSql(sql)
+        except QgsProviderConnectionException as e:
+            feedback.pushInfo(f"Aggiornamento SQL non riuscito ({e}), aggiornamento elemento per elemento")
+            return False
 
-            if inner_dict:
-                result[matrix[i]][matrix[i + 1]] = (matrix[i + 2], matrix[i + 3])
-            else:
-                result[matrix[i]] = {matrix[i + 1]: (matrix[i + 2], matrix[i + 3])}
+        return True
 
-        return result
+    def process_matrix_param(self, matrix):
+        """Return dict of tuples e.g. { intensity = ([return_years, ...], [(matrix_value, danger), ...]) }
+        with the return years sorted, compiled only once per matrix"""
+        return compile_matrix(tuple(int(value) for value in matrix))
 
     def get_matrix_value(self, processed_matrix, intensity, return_years):
 
-        inner_dict = processed_matrix[intensity]
+        if intensity is None or intensity == NULL or intensity not in processed_matrix:
+            raise QgsProcessingException(f"Intensità {intensity} non presente nella matrice")
+        if return_years is None or return_years == NULL:
+            raise QgsProcessingException(f"Periodo di ritorno mancante per l'intensità {intensity}")
+
+        thresholds, values = processed_matrix[intensity]
 
         # Smallest key in matrix greater than or equal to return years
-        min_key = min(i for i in inner_dict.keys() if i >= return_years)
+        idx = bisect_left(thresholds, return_years)
+        if idx == len(thresholds):
+            raise QgsProcessingException(
+                f"Nessun periodo di ritorno nella matrice per l'intensità {intensity} e il periodo {return_years}"
+            )
+
+        return values[idx]
+
+
+@lru_cache(maxsize=None)
+def compile_matrix(matrix):
+    """Compile a flat tuple (intensity, return years, matrix value, danger, ...) to sorted lookup tables"""
+    rows = {}
+    for i in range(0, len(matrix), 4):
+        rows.setdefault(matrix[i], {})[matrix[i + 1]] = (matrix[i + 2], matrix[i + 3])
+
+    result = {}
+    for intensity, inner_dict in rows.items():
+        thresholds = sorted(inner_dict.keys())
+        result[intensity] = (thresholds, [inner_dict[threshold] for threshold in thresholds])
+
+    return result
+
+
+def quote_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def matrix_case_sql(processed_matrix, intensity_field, period_field, value_idx):
+    """SQL CASE expression giving the element value_idx of the matrix values (0 matrix value, 1 danger)"""
+    intensity = quote_identifier(intensity_field)
+    period = quote_identifier(period_field)
+
+    whens = []
+    for matrix_intensity, (thresholds, values) in processed_matrix.items():
+        # Thresholds are sorted, the first match is the smallest one greater than or equal to the period
+        for threshold, value in zip(thresholds, values):
+            whens.append(f"WHEN {intensity} = {matrix_intensity} AND {period} <= {threshold} THEN {value[value_idx]}")
 
-        return inner_dict[min_key]
+    return "CASE {} END".format(" ".join(whens))
@@ -1,24 +1,43 @@
 from qgis import processing
 from qgis.core import (
     QgsApplication,
+    QgsCoordinateReferenceSystem,
+    QgsFeatureRequest,
+    QgsFeatureSink,
     QgsField,
     QgsFields,
     QgsProcessing,
     QgsProcessingAlgorithm,
+    QgsProcessingContext,
     QgsProcessingException,
+    QgsProcessingFeedback,
     QgsProcessingParameterFeatureSink,
     QgsProcessingParameterFeatureSource,
     QgsProcessingParameterField,
+    QgsProcessingParameterNumber,
+    QgsProcessingUtils,
+    QgsWkbTypes,
 )
 from qgis.PyQt.QtCore import QVariant
 
 from pzp_utils.processing.merge_by_area import MergeByArea
+from pzp_utils.processing.overlay import difference
+from pzp_utils.processing.parallel import (
+    features_to_tuples,
+    fields_to_tuples,
+    process_pool,
+    tuples_to_features,
+    tuples_to_fields,
+)
+from pzp_utils.processing.partition import features_to_layer, partition_layers
+from pzp_utils.processing.repair import fix_layer
 
 
 class DangerZones(QgsProcessingAlgorithm):
     INPUT = "INPUT"
     MATRIX_FIELD = "MATRIX_FIELD"
     PROCESS_SOURCE_FIELD = "PROCESS_SOURCE_FIELD"
+    WORKERS = "WORKERS"
     OUTPUT = "OUTPUT"
 
     def createInstance(self):
@@ -62,6 +81,16 @@ class DangerZones(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                "Numero di processi paralleli per le fonti del processo",
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                defaultValue=1,
+            )
+        )
+
         self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, "Zone di pericolo"))
 
     def processAlgorithm(self, parameters, context, feedback):
@@ -97,7 +126,7 @@ class DangerZones(QgsProcessingAlgorithm):
         used_matrix_values = set()
         process_sources = set()
 
-        for feature in source.getFeatures():
+        for feature in source.getFeatures(QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)):
             process_sources.add(feature[process_source_field])
             used_matrix_values.add(feature[matrix_field])
 
@@ -124,58 +153,156 @@ class DangerZones(QgsProcessingAlgorithm):
             feedback=feedback,
             is_child_algorithm=True,
         )
-        input_layer = result["OUTPUT"]
+        input_layer = QgsProcessingUtils.mapLayerFromString(result["OUTPUT"], context)
 
-        final_layer = None
+        # Read the dissolved layer only once, grouped by (process source, matrix value)
+        groups = partition_layers(input_layer, [process_source_field, matrix_field], feedback=feedback)
+
+        process_source_layers = {}
         for process_source in process_sources:
-            result = self.prepare_process_source(
+            matrix_layers = {
+                matrix_value: groups[(process_source, matrix_value)]
+                for matrix_value in used_matrix_values
+                if (process_source, matrix_value) in groups
+            }
+            if matrix_layers:
+                process_source_layers[process_source] = matrix_layers
+
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
+        if workers > 1 and len(process_source_layers) > 1:
+            outputs = self.prepare_process_sources_in_pool(
+                process_source_layers,
+                workers,
                 input_layer,
-                used_matrix_values,
-                process_source,
                 matrix_field,
                 process_source_field,
-                parameters,
                 context,
                 feedback,
             )
+        else:
+            outputs = (
+                self.prepare_process_source(
+                    matrix_layers,
+                    process_source,
+                    matrix_field,
+                    process_source_field,
+                    context,
+                    feedback,
+                )["OUTPUT"]
+                for process_source, matrix_layers in process_source_layers.items()
+            )
+
+        # Stream the layer of every process source straight into the output sink, so the
+        # features computed so far are not copied again for every process source
+        sink = None
+        dest_id = None
+        for output in outputs:
+            layer = QgsProcessingUtils.mapLayerFromString(output, context)
+            if sink is None:
+                (sink, dest_id) = self.parameterAsSink(
+                    parameters,
+                    self.OUTPUT,
+                    context,
+                    layer.fields(),
+                    layer.wkbType(),
+                    layer.crs(),
+                )
+                if sink is None:
+                    raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+
+            for feature in layer.getFeatures():
+                sink.addFeature(feature, QgsFeatureSink.FastInsert)
 
-            if final_layer:
-                result = processing.run(
-                    "native:mergevectorlayers",
+            context.temporaryLayerStore().removeMapLayer(layer)
+
+        return {self.OUTPUT: dest_id}
+
+    def prepare_process_sources_in_pool(
+        self,
+        process_source_layers,
+        workers,
+        input_layer,
+        matrix_field,
+        process_source_field,
+        context,
+        feedback,
+    ):
+        """Run prepare_process_source for every process source on a pool of worker processes
+        and yield the ids of the resulting layers, in the order of process_source_layers"""
+        field_tuples = fields_to_tuples(input_layer.fields())
+        wkb_type = QgsWkbTypes.displayString(input_layer.wkbType())
+        crs_wkt = input_layer.crs().toWkt()
+
+        with process_pool(workers, init_processing=True) as pool:
+            futures = [
+                pool.submit(
+                    prepare_process_source_in_worker,
                     {
-                        "LAYERS": [result["OUTPUT"], final_layer],
-                        "OUTPUT": "memory:",
+                        matrix_value: features_to_tuples(matrix_layer.getFeatures())
+                        for matrix_value, matrix_layer in matrix_layers.items()
                     },
-                    context=context,
-                    feedback=feedback,
-                    is_child_algorithm=True,
+                    process_source,
+                    matrix_field,
+                    process_source_field,
+                    field_tuples,
+                    wkb_type,
+                    crs_wkt,
+                )
+                for process_source, matrix_layers in process_source_layers.items()
+            ]
+
+            for i, future in enumerate(futures):
+                if feedback.isCanceled():
+                    for pending in futures:
+                        pending.cancel()
+                    break
+
+                output_field_tuples, output_wkb_type, feature_tuples = future.result()
+                output_fields = tuples_to_fields(output_field_tuples)
+                layer = features_to_layer(
+                    tuples_to_features(feature_tuples, output_fields),
+                    output_fields,
+                    QgsWkbTypes.parseType(output_wkb_type),
+                    input_layer.crs(),
                 )
-            final_layer = result["OUTPUT"]
+                context.temporaryLayerStore().addMapLayer(layer)
+                feedback.setProgress(100 * (i + 1) / len(futures))
 
-        return {self.OUTPUT: final_layer}
+                yield layer.id()
 
     def prepare_process_source(
         self,
-        input_layer,
-        used_matrix_values,
+        matrix_layers,
         process_source,
         matrix_field,
         process_source_field,
-        parameters,
         context,
         feedback,
     ):
-        # Escape ' in process_source
-        process_source = process_source.replace("'", "''")
+        """matrix_layers is a dict { matrix_value: layer } ordered by matrix priority"""
 
         final_layer = None
-        for matrix_value in used_matrix_values:
+        for matrix_value, matrix_layer in matrix_layers.items():
             feedback.pushInfo(f'"{matrix_field}" = {matrix_value} AND "{process_source_field}" = \'{process_source}\'')
+            if final_layer is None:
+                final_layer = matrix_layer
+                continue
+
+            # Each matrix value is clipped by the cleaned coverage of the values with a higher
+            # priority, so the slivers removed below are free for the next values to fill
+            features = difference(matrix_layer, final_layer, feedback)
+            features.extend(final_layer.getFeatures())
+            merged_layer = features_to_layer(
+                features,
+                matrix_layer.fields(),
+                QgsWkbTypes.multiType(matrix_layer.wkbType()),
+                matrix_layer.crs(),
+            )
+
             result = processing.run(
-                "native:extractbyexpression",
+                "native:multiparttosingleparts",
                 {
-                    "INPUT": input_layer,
-                    "EXPRESSION": f'"{matrix_field}" = {matrix_value} AND "{process_source_field}" = \'{process_source}\'',
+                    "INPUT": merged_layer,
                     "OUTPUT": "memory:",
                 },
                 context=context,
@@ -183,85 +310,45 @@ class DangerZones(QgsProcessingAlgorithm):
                 is_child_algorithm=True,
             )
 
-            if final_layer:
-                result = processing.run(
-                    "native:difference",
-                    {
-                        "INPUT": result["OUTPUT"],
-                        "OVERLAY": final_layer,
-                        "OUTPUT": "memory:",
-                    },
-                    context=context,
-                    feedback=feedback,
-                    is_child_algorithm=True,
-                )
-
-                result = processing.run(
-                    "native:mergevectorlayers",
-                    {
-                        "LAYERS": [result["OUTPUT"], final_layer],
-                        "OUTPUT": "memory:",
-                    },
-                    context=context,
-                    feedback=feedback,
-                    is_child_algorithm=True,
-                )
-
-                result = processing.run(
-                    "native:multiparttosingleparts",
-                    {
-                        "INPUT": result["OUTPUT"],
-                        "OUTPUT": "memory:",
-                    },
-                    context=context,
-                    feedback=feedback,
-                    is_child_algorithm=True,
-                )
-
-                result = processing.run(
-                    "native:fixgeometries",
-                    {"INPUT": result["OUTPUT"], "OUTPUT": "memory:"},
-                    context=context,
-                    feedback=feedback,
-                    is_child_algorithm=True,
-                )
-
-                result = processing.run(
-                    "pzp:merge_by_area",
-                    {
-                        "INPUT": result["OUTPUT"],
-                        "MODE": MergeByArea.MODE_BOUNDARY,
-                        "OUTPUT": "memory:",
-                    },
-                    context=context,
-                    feedback=feedback,
-                    is_child_algorithm=True,
-                )
+            # Most geometries are valid here, only the invalid ones are repaired
+            single_layer = QgsProcessingUtils.mapLayerFromString(result["OUTPUT"], context)
+            fix_layer(single_layer, feedback)
 
-                result = processing.run(
-                    "native:multiparttosingleparts",
-                    {
-                        "INPUT": result["OUTPUT"],
-                        "OUTPUT": "memory:",
-                    },
-                    context=context,
-                    feedback=feedback,
-                    is_child_algorithm=True,
-                )
+            result = processing.run(
+                "pzp:merge_by_area",
+                {
+                    "INPUT": single_layer,
+                    "MODE": MergeByArea.MODE_BOUNDARY,
+                    "OUTPUT": "memory:",
+                },
+                context=context,
+                feedback=feedback,
+                is_child_algorithm=True,
+            )
 
-                # Workaround to re-remove small invalid parts that comes back after multi to single
-                result = processing.run(
-                    "pzp:remove_by_area",
-                    {
-                        "INPUT": result["OUTPUT"],
-                        "OUTPUT": "memory:",
-                    },
-                    context=context,
-                    feedback=feedback,
-                    is_child_algorithm=True,
-                )
+            result = processing.run(
+                "native:multiparttosingleparts",
+                {
+                    "INPUT": result["OUTPUT"],
+                    "OUTPUT": "memory:",
+                },
+                context=context,
+                feedback=feedback,
+                is_child_algorithm=True,
+            )
 
-            final_layer = result["OUTPUT"]
+            # Workaround to re-remove small invalid parts that comes back after multi to single
+            result = processing.run(
+                "pzp:remove_by_area",
+                {
+                    "INPUT": result["OUTPUT"],
+                    "OUTPUT": "memory:",
+                },
+                context=context,
+                feedback=feedback,
+                is_child_algorithm=True,
+            )
+            final_layer = QgsProcessingUtils.mapLayerFromString(result["OUTPUT"], context)
 
         result = processing.run(
             "native:multiparttosingleparts",
@@ -284,7 +371,7 @@ class DangerZones(QgsProcessingAlgorithm):
             {
                 "INPUT": result["OUTPUT"],
                 "COLUMN": ["fid", "layer", "path"],
-                "OUTPUT": parameters[self.OUTPUT],
+                "OUTPUT": "memory:",
             },
             context=context,
             feedback=feedback,
@@ -292,3 +379,41 @@ class DangerZones(QgsProcessingAlgorithm):
         )
 
         return result
+
+
+def prepare_process_source_in_worker(
+    matrix_groups,
+    process_source,
+    matrix_field,
+    process_source_field,
+    field_tuples,
+    wkb_type,
+    crs_wkt,
+):
+    """Entry point of the worker processes started by DangerZones.prepare_process_sources_in_pool"""
+    fields = tuples_to_fields(field_tuples)
+    crs = QgsCoordinateReferenceSystem.fromWkt(crs_wkt)
+    matrix_layers = {
+        matrix_value: features_to_layer(
+            tuples_to_features(feature_tuples, fields), fields, QgsWkbTypes.parseType(wkb_type), crs
+        )
+        for matrix_value, feature_tuples in matrix_groups.items()
+    }
+
+    context = QgsProcessingContext()
+    feedback = QgsProcessingFeedback()
+    result = DangerZones().prepare_process_source(
+        matrix_layers,
+        process_source,
+        matrix_field,
+        process_source_field,
+        context,
+        feedback,
+    )
+
+    layer = QgsProcessingUtils.mapLayerFromString(result["OUTPUT"], context)
+    return (
+        fields_to_tuples(layer.fields()),
+        QgsWkbTypes.displayString(layer.wkbType()),
+        features_to_tuples(layer.getFeatures()),
+    )
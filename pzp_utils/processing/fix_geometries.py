@@ -1,16 +1,32 @@
 from qgis import processing
 from qgis.core import (
+    QgsFeatureRequest,
+    QgsFeatureSink,
+    QgsGeometry,
+    QgsMemoryProviderUtils,
     QgsProcessing,
     QgsProcessingAlgorithm,
+    QgsProcessingException,
+    QgsProcessingFeatureSource,
     QgsProcessingParameterFeatureSink,
     QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterNumber,
+    QgsProcessingUtils,
+    QgsWkbTypes,
 )
 
+from pzp_utils.processing.parallel import chunks, process_pool, submit_in_order
+from pzp_utils.processing.repair import REPAIR_STEPS, repair_wkb_chunk
+
 
 class FixGeometries(QgsProcessingAlgorithm):
     INPUT = "INPUT"
+    WORKERS = "WORKERS"
     OUTPUT = "OUTPUT"
 
+    # Features sent to a worker process at once
+    WORKER_CHUNK_SIZE = 1000
+
     def createInstance(self):
         return FixGeometries()
 
@@ -38,115 +54,91 @@ class FixGeometries(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                "Numero di processi paralleli per la correzione delle geometrie",
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                defaultValue=1,
+            )
+        )
+
         self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, "Output layer"))
 
     def processAlgorithm(self, parameters, context, feedback):
+        source = self.parameterAsSource(parameters, self.INPUT, context)
 
-        result = processing.run(
-            "native:fixgeometries",
-            {"INPUT": parameters[self.INPUT], "OUTPUT": "memory:"},
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
+        if source is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
 
-        result = processing.run(
-            "pzp:merge_by_area",
-            {
-                "INPUT": result["OUTPUT"],
-                "MODE": 2,
-                "OUTPUT": parameters[self.OUTPUT],
-            },
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
-
-        result = processing.run(
-            "native:snappointstogrid",
-            {
-                "INPUT": result["OUTPUT"],
-                "HSPACING": 0.001,
-                "VSPACING": 0.001,
-                "ZSPACING": 0,
-                "MSPACING": 0,
-                "OUTPUT": "memory:",
-            },
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
-
-        result = processing.run(
-            "native:buffer",
-            {
-                "INPUT": result["OUTPUT"],
-                "DISTANCE": -1e-06,
-                "SEGMENTS": 5,
-                "END_CAP_STYLE": 0,
-                "JOIN_STYLE": 0,
-                "MITER_LIMIT": 2,
-                "DISSOLVE": False,
-                "OUTPUT": "memory:",
-            },
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
+        wkb_type = QgsWkbTypes.multiType(source.wkbType())
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
 
-        result = processing.run(
-            "native:snappointstogrid",
-            {
-                "INPUT": result["OUTPUT"],
-                "HSPACING": 0.001,
-                "VSPACING": 0.001,
-                "ZSPACING": 0,
-                "MSPACING": 0,
-                "OUTPUT": "memory:",
-            },
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
+        # Merging slivers needs the whole layer, so the first repair is written to a memory layer
+        fixed_layer = QgsMemoryProviderUtils.createMemoryLayer("fixed", source.fields(), wkb_type, source.sourceCrs())
+        fixed_provider = fixed_layer.dataProvider()
+        # The invalid geometries are the ones to repair, they must not stop the algorithm
+        features = source.getFeatures(QgsFeatureRequest(), QgsProcessingFeatureSource.FlagSkipGeometryValidityChecks)
+        for feature, geometry in self.repair_features(features, "fix", workers, feedback):
+            feature.setGeometry(geometry)
+            fixed_provider.addFeature(feature, QgsFeatureSink.FastInsert)
 
         result = processing.run(
-            "native:buffer",
+            "pzp:merge_by_area",
             {
-                "INPUT": result["OUTPUT"],
-                "DISTANCE": 1e-06,
-                "SEGMENTS": 5,
-                "END_CAP_STYLE": 0,
-                "JOIN_STYLE": 0,
-                "MITER_LIMIT": 2,
-                "DISSOLVE": False,
+                "INPUT": fixed_layer,
+                "MODE": 2,
                 "OUTPUT": "memory:",
             },
             context=context,
             feedback=feedback,
             is_child_algorithm=True,
         )
-
-        result = processing.run(
-            "native:snappointstogrid",
-            {
-                "INPUT": result["OUTPUT"],
-                "HSPACING": 0.001,
-                "VSPACING": 0.001,
-                "ZSPACING": 0,
-                "MSPACING": 0,
-                "OUTPUT": "memory:",
-            },
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+        merged_layer = QgsProcessingUtils.mapLayerFromString(result["OUTPUT"], context)
+
+        (sink, dest_id) = self.parameterAsSink(
+            parameters,
+            self.OUTPUT,
+            context,
+            merged_layer.fields(),
+            wkb_type,
+            source.sourceCrs(),
         )
-
-        result = processing.run(
-            "native:fixgeometries",
-            {"INPUT": result["OUTPUT"], "OUTPUT": "memory:"},
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+
+        # All the other steps are per feature: snap to grid, negative buffer, snap, positive buffer,
+        # snap and fix are done in a single pass, straight into the output
+        for feature, geometry in self.repair_features(merged_layer.getFeatures(), "clean", workers, feedback):
+            feature.setGeometry(geometry)
+            sink.addFeature(feature, QgsFeatureSink.FastInsert)
+
+        return {self.OUTPUT: dest_id}
+
+    def repair_features(self, features, step, workers, feedback):
+        """Yield (feature, repaired geometry) for every feature, in the same order, a null geometry
+        when nothing valid is left. With more than one worker the geometries are repaired in
+        chunks on a pool of worker processes."""
+        if workers <= 1:
+            repair = REPAIR_STEPS[step]
+            for feature in features:
+                if feedback.isCanceled():
+                    return
+                yield feature, repair(feature.geometry())
+            return
+
+        tasks = (
+            (chunk, (step, [bytes(feature.geometry().asWkb()) for feature in chunk]))
+            for chunk in chunks(features, self.WORKER_CHUNK_SIZE)
         )
-
-        return {self.OUTPUT: result["OUTPUT"]}
+        with process_pool(workers) as pool:
+            for chunk, wkbs in submit_in_order(pool, repair_wkb_chunk, tasks, 2 * workers):
+                if feedback.isCanceled():
+                    return
+
+                for feature, wkb in zip(chunk, wkbs):
+                    geometry = QgsGeometry()
+                    if wkb is not None:
+                        geometry.fromWkb(wkb)
+                    yield feature, geometry
@@ -0,0 +1,282 @@
+"""
+In-process versions of the GRASS v.generalize methods used by SimplifyIntensity
+(method 8, chaiken, and method 3, reduction), working on the coordinates of
+each polygon ring as NumPy arrays, so no GRASS session is needed.
+"""
+
+import numpy as np
+from qgis.core import QgsGeometry, QgsLineString, QgsMultiPolygon, QgsPolygon
+
+from pzp_utils.processing.parallel import chunks, process_pool, submit_in_order
+
+# Same as the GRASS implementation, chaiken refines a corner until the new point is closer
+# than the threshold to the previous one; this caps the refinement for tiny thresholds
+CHAIKEN_MAX_DEPTH = 32
+
+# Points looked at in one go when searching the next point kept by the reduction
+REDUCTION_WINDOW = 64
+
+# Arcs sent to a worker process at once
+ARCS_CHUNK_SIZE = 5000
+
+
+def refine_corners(p0, p1, p2, threshold):
+    """Chaiken refinement of the corners p1, going from p0 to the middle of p1 and p2,
+    all corners at once. Return the points of all corners, one corner after the other."""
+    threshold *= threshold
+
+    levels = []
+    active_levels = []
+    active = np.ones(len(p1), dtype=bool)
+    for _ in range(CHAIKEN_MAX_DEPTH):
+        middle = (p1 + p2) / 2
+        levels.append(middle)
+        active_levels.append(active)
+
+        active = active & (np.sum((middle - p0) ** 2, axis=1) > threshold)
+        if not active.any():
+            break
+
+        # refine towards the start of the corner
+        p2 = (p1 + middle) / 2
+        p1 = (p1 + p0) / 2
+
+    # The points of a corner go from the deepest refinement back to the middle of the next edge
+    return np.stack(levels[::-1], axis=1)[np.stack(active_levels[::-1], axis=1)]
+
+
+def chaiken(coords, threshold):
+    """Chaiken smoothing of a closed ring given as an (n, 2) array whose last point repeats
+    the first one"""
+    vertices = coords[:-1]
+    if len(vertices) < 3:
+        return coords
+
+    # Each corner starts from the middle of the previous edge (where the previous corner ends)
+    # and ends in the middle of the next edge
+    points = refine_corners(
+        (np.roll(vertices, 1, axis=0) + vertices) / 2,
+        vertices,
+        np.roll(vertices, -1, axis=0),
+        threshold,
+    )
+    return np.vstack((points, points[:1]))
+
+
+def chaiken_line(coords, threshold):
+    """Chaiken smoothing of an open line, its end points don't move"""
+    if len(coords) < 3:
+        return coords
+
+    vertices = coords[1:-1]
+    starts = (coords[:-2] + vertices) / 2
+    starts[0] = coords[0]
+    points = refine_corners(starts, vertices, coords[2:], threshold)
+    return np.vstack((coords[:1], points, coords[-1:]))
+
+
+def reduction(coords, threshold):
+    """Keep a point only if it is at least threshold away from the last kept one.
+    The first and the last points are always kept."""
+    n = len(coords)
+    if n < 3:
+        return coords
+
+    threshold *= threshold
+    kept = [0]
+    last = 0
+    start = 1
+    while start < n - 1:
+        stop = min(start + REDUCTION_WINDOW, n - 1)
+        far = np.flatnonzero(np.sum((coords[start:stop] - coords[last]) ** 2, axis=1) >= threshold)
+        if far.size == 0:
+            start = stop
+            continue
+
+        last = start + far[0]
+        kept.append(last)
+        start = last + 1
+
+    kept.append(n - 1)
+    return coords[kept]
+
+
+def generalize_ring(ring, chaiken_threshold, reduce_threshold):
+    """Return the generalized ring as a QgsLineString, or None if it collapses"""
+    coords = np.column_stack((ring.xVector(), ring.yVector()))
+    return to_ring(reduction(chaiken(coords, chaiken_threshold), reduce_threshold))
+
+
+def to_ring(coords):
+    # A ring needs at least three distinct points
+    if len(coords) < 4:
+        return None
+    return QgsLineString(coords[:, 0].tolist(), coords[:, 1].tolist())
+
+
+def generalize_geometry(geometry, chaiken_threshold, reduce_threshold):
+    """Chaiken smoothing followed by reduction of every ring of a polygon geometry, like
+    two back to back GRASS v.generalize runs. Return None when every polygon collapses."""
+    result = QgsMultiPolygon()
+    for part in geometry.asGeometryCollection():
+        polygon = part.constGet()
+
+        exterior = generalize_ring(polygon.exteriorRing(), chaiken_threshold, reduce_threshold)
+        if exterior is None:
+            continue
+
+        generalized = QgsPolygon()
+        generalized.setExteriorRing(exterior)
+        for i in range(polygon.numInteriorRings()):
+            interior = generalize_ring(polygon.interiorRing(i), chaiken_threshold, reduce_threshold)
+            if interior is not None:
+                generalized.addInteriorRing(interior)
+        result.addGeometry(generalized)
+
+    if result.isEmpty():
+        return None
+    return QgsGeometry(result)
+
+
+def polygon_rings(polygon):
+    yield polygon.exteriorRing()
+    for i in range(polygon.numInteriorRings()):
+        yield polygon.interiorRing(i)
+
+
+def ring_points(ring):
+    """Points of a ring as (x, y) tuples, without the closing one"""
+    return list(zip(ring.xVector(), ring.yVector()))[:-1]
+
+
+def find_junctions(rings):
+    """Points where rings going through the same point don't go on the same way"""
+    neighbours = {}
+    junctions = set()
+    for ring in rings:
+        for i, point in enumerate(ring):
+            pair = frozenset((ring[i - 1], ring[(i + 1) % len(ring)]))
+            if neighbours.setdefault(point, pair) != pair:
+                junctions.add(point)
+    return junctions
+
+
+class ArcTopology:
+    """Boundaries of polygons split at the junctions into arcs, like TopoJSON does:
+    a boundary shared by two polygons is stored once and rings are lists of
+    (arc index, reversed) going around them."""
+
+    def __init__(self, junctions):
+        self.junctions = junctions
+        self.arcs = []
+        self.closed = []
+        self._arc_index = {}
+
+    def add_arc(self, points, closed):
+        key = tuple(points)
+        index = self._arc_index.get(key)
+        if index is not None:
+            return index, False
+        index = self._arc_index.get(key[::-1])
+        if index is not None:
+            return index, True
+
+        self._arc_index[key] = len(self.arcs)
+        self.arcs.append(key)
+        self.closed.append(closed)
+        return len(self.arcs) - 1, False
+
+    def add_ring(self, ring):
+        starts = [i for i, point in enumerate(ring) if point in self.junctions]
+        if not starts:
+            # A ring without junctions is a single closed arc, starting from its lowest point so
+            # the same ring of two polygons (a hole and the island filling it) gives the same arc
+            start = ring.index(min(ring))
+            points = ring[start:] + ring[:start]
+            return [self.add_arc(points + points[:1], True)]
+
+        points = ring[starts[0] :] + ring[: starts[0]]
+        points.append(points[0])
+        offsets = [i - starts[0] for i in starts] + [len(ring)]
+        return [self.add_arc(points[start : end + 1], False) for start, end in zip(offsets, offsets[1:])]
+
+    def ring_coords(self, ring_arcs, arcs_coords):
+        parts = []
+        for index, is_reversed in ring_arcs:
+            coords = arcs_coords[index][::-1] if is_reversed else arcs_coords[index]
+            # consecutive arcs share their end point
+            parts.append(coords[1:] if parts else coords)
+        return np.vstack(parts)
+
+
+def generalize_arcs(arcs, closed, chaiken_threshold, reduce_threshold):
+    """Generalize arcs given as sequences of points, closed ones as rings and open ones keeping
+    their end points. Also the entry point of the worker processes."""
+    return [
+        reduction(
+            chaiken(coords, chaiken_threshold) if is_closed else chaiken_line(coords, chaiken_threshold),
+            reduce_threshold,
+        )
+        for coords, is_closed in zip((np.array(arc) for arc in arcs), closed)
+    ]
+
+
+def generalize_wkb_chunk(wkbs, chaiken_threshold, reduce_threshold):
+    """Entry point of the worker processes: generalize_geometry on WKB geometries, returning
+    WKB, or None for the geometries which collapse, in the same order"""
+    result = []
+    for wkb in wkbs:
+        geometry = QgsGeometry()
+        geometry.fromWkb(wkb)
+        generalized = generalize_geometry(geometry, chaiken_threshold, reduce_threshold)
+        result.append(None if generalized is None else bytes(generalized.asWkb()))
+    return result
+
+
+def generalize_topology(geometries, chaiken_threshold, reduce_threshold, workers=1):
+    """Chaiken smoothing and reduction of polygon geometries sharing boundaries: every
+    boundary is generalized once, as an arc, and the polygons are rebuilt from the
+    generalized arcs, so neighbours stay without gaps or overlaps.
+    With more than one worker, the arcs are generalized on a pool of worker processes.
+    Return the generalized geometries in the same order, None for those which collapse."""
+    # [geometry][polygon][ring] -> points of the ring
+    rings = [
+        [[ring_points(ring) for ring in polygon_rings(part.constGet())] for part in geometry.asGeometryCollection()]
+        for geometry in geometries
+    ]
+
+    topology = ArcTopology(find_junctions(ring for polygons in rings for polygon in polygons for ring in polygon))
+    rings = [[[topology.add_ring(ring) for ring in polygon] for polygon in polygons] for polygons in rings]
+
+    if workers <= 1:
+        arcs_coords = generalize_arcs(topology.arcs, topology.closed, chaiken_threshold, reduce_threshold)
+    else:
+        # Arcs are independent from each other once the junctions are fixed
+        tasks = (
+            (None, (arcs, closed, chaiken_threshold, reduce_threshold))
+            for arcs, closed in zip(chunks(topology.arcs, ARCS_CHUNK_SIZE), chunks(topology.closed, ARCS_CHUNK_SIZE))
+        )
+        with process_pool(workers) as pool:
+            arcs_coords = [
+                coords for _, chunk in submit_in_order(pool, generalize_arcs, tasks, 2 * workers) for coords in chunk
+            ]
+
+    result = []
+    for polygons in rings:
+        multi_polygon = QgsMultiPolygon()
+        for polygon in polygons:
+            exterior = to_ring(topology.ring_coords(polygon[0], arcs_coords))
+            if exterior is None:
+                continue
+
+            generalized = QgsPolygon()
+            generalized.setExteriorRing(exterior)
+            for ring_arcs in polygon[1:]:
+                interior = to_ring(topology.ring_coords(ring_arcs, arcs_coords))
+                if interior is not None:
+                    generalized.addInteriorRing(interior)
+            multi_polygon.addGeometry(generalized)
+
+        result.append(None if multi_polygon.isEmpty() else QgsGeometry(multi_polygon))
+
+    return result
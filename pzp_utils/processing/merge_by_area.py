@@ -19,6 +19,7 @@ Derived from:
 
 
 import os
+from collections import deque
 
 from processing.algs.qgis.QgisAlgorithm import QgisAlgorithm
 from qgis.core import (
@@ -28,21 +29,76 @@ from qgis.core import (
     QgsGeometry,
     QgsProcessing,
     QgsProcessingException,
+    QgsProcessingParameterBoolean,
     QgsProcessingParameterEnum,
     QgsProcessingParameterFeatureSink,
     QgsProcessingParameterFeatureSource,
     QgsProcessingParameterField,
     QgsProcessingUtils,
+    QgsSpatialIndex,
 )
 
 pluginPath = os.path.split(os.path.split(os.path.dirname(__file__))[0])[0]
 
 
+# Vertices closer than this are considered the same when looking for shared boundary segments
+BOUNDARY_PRECISION = 1e-6
+
+# Candidates are clipped to the bounding box of the polygon to eliminate, grown by this margin,
+# before hashing their segments: shared segments lie inside that box
+BOUNDARY_CLIP_MARGIN = 1.0
+
+
+def boundary_segments(geometry):
+    """Return the segments of all the rings of a polygon as { (vertex, vertex): length }, with the
+    vertices snapped to BOUNDARY_PRECISION and sorted so the direction of the ring doesn't matter"""
+    segments = {}
+    polygons = geometry.asMultiPolygon() if geometry.isMultipart() else [geometry.asPolygon()]
+    for polygon in polygons:
+        for ring in polygon:
+            vertices = [
+                (round(point.x() / BOUNDARY_PRECISION), round(point.y() / BOUNDARY_PRECISION)) for point in ring
+            ]
+            for i in range(len(ring) - 1):
+                if vertices[i] == vertices[i + 1]:
+                    continue
+                segment = tuple(sorted((vertices[i], vertices[i + 1])))
+                segments[segment] = segments.get(segment, 0) + ring[i].distance(ring[i + 1])
+    return segments
+
+
+def inside_segment(point, segment):
+    """True if the snapped point lies on the segment, within one snapping unit, but not on its ends"""
+    (ax, ay), (bx, by) = segment
+    px, py = point
+    dx, dy = bx - ax, by - ay
+    squaredLength = dx * dx + dy * dy
+    projection = (px - ax) * dx + (py - ay) * dy
+    if projection <= 0 or projection >= squaredLength:
+        return False
+    cross = (px - ax) * dy - (py - ay) * dx
+    return cross * cross <= squaredLength
+
+
+def fully_noded(segmentsA, segmentsB):
+    """True if the two boundaries only touch along whole shared segments: no vertex of one lies
+    inside a segment of the other. Overlapping segments always have such a vertex unless they
+    are the same segment, so then the shared segments are the whole contact."""
+    verticesA = {vertex for segment in segmentsA for vertex in segment}
+    verticesB = {vertex for segment in segmentsB for vertex in segment}
+    for vertices, segments in ((verticesA - verticesB, segmentsB), (verticesB - verticesA, segmentsA)):
+        for vertex in vertices:
+            if any(inside_segment(vertex, segment) for segment in segments):
+                return False
+    return True
+
+
 class MergeByArea(QgisAlgorithm):
     INPUT = "INPUT"
     OUTPUT = "OUTPUT"
     MODE = "MODE"
     VALUE_FIELD = "VALUE_FIELD"
+    BATCH = "BATCH"
 
     MODE_LARGEST_AREA = 0
     MODE_SMALLEST_AREA = 1
@@ -76,6 +132,14 @@ class MergeByArea(QgisAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.BATCH,
+                self.tr("Assign all polygons first, then merge each neighbour only once"),
+                defaultValue=False,
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr("Eliminated"), QgsProcessing.TypeVectorPolygon)
         )
@@ -90,6 +154,7 @@ class MergeByArea(QgisAlgorithm):
         inLayer = self.parameterAsSource(parameters, self.INPUT, context)
         mode = self.parameterAsEnum(parameters, self.MODE, context)
         valueField = self.parameterAsFields(parameters, self.VALUE_FIELD, context)
+        batch = self.parameterAsBool(parameters, self.BATCH, context)
 
         featToEliminate = []
 
@@ -110,9 +175,25 @@ class MergeByArea(QgisAlgorithm):
                 sink.addFeature(feature, QgsFeatureSink.FastInsert)
         del sink
 
-        # Delete all features to eliminate in processLayer
         processLayer = QgsProcessingUtils.mapLayerFromString(dest_id, context)
-        processLayer.startEditing()
+
+        # Geometries are written straight to the provider, without an edit session keeping
+        # both the old and the new geometries in its buffer
+        provider = processLayer.dataProvider()
+
+        # Spatial index and geometries of the kept polygons, built once and updated on every merge
+        index = QgsSpatialIndex()
+        geometries = {}
+        for feature in provider.getFeatures(QgsFeatureRequest().setNoAttributes()):
+            geometries[feature.id()] = feature.geometry()
+            index.addFeature(feature.id(), feature.geometry().boundingBox())
+
+        if batch:
+            self.merge_batched(provider, featToEliminate, index, geometries, mode, feedback)
+            return {self.OUTPUT: dest_id}
+
+        # Kept polygons that absorbed something, written all at once at the end
+        changedFids = set()
 
         # ANALYZE
         if len(featToEliminate) > 0:  # Prevent zero division
@@ -122,103 +203,52 @@ class MergeByArea(QgisAlgorithm):
             start = 100
 
         feedback.setProgress(start)
-        madeProgress = True
-
-        # We go through the list and see if we find any polygons we can
-        # merge the selected with. If we have no success with some we
-        # merge and then restart the whole story.
-        while madeProgress:  # Check if we made any progress
-            madeProgress = False
-            featNotEliminated = []
-
-            # Iterate over the polygons to eliminate
-            for i in range(len(featToEliminate)):
-                if feedback.isCanceled():
-                    break
-
-                feat = featToEliminate.pop()
-                geom2Eliminate = feat.geometry()
-                bbox = geom2Eliminate.boundingBox()
-                fit = processLayer.getFeatures(QgsFeatureRequest().setFilterRect(bbox).setSubsetOfAttributes([]))
-                mergeWithFid = None
-                mergeWithGeom = None
-                max = None
-                selFeat = QgsFeature()
-
-                # use prepared geometries for faster intersection tests
-                engine = QgsGeometry.createGeometryEngine(geom2Eliminate.constGet())
-                engine.prepareGeometry()
-
-                while fit.nextFeature(selFeat):
-                    if feedback.isCanceled():
-                        break
-
-                    selGeom = selFeat.geometry()
-
-                    if engine.intersects(selGeom.constGet()):
-                        # We have a candidate
-                        iGeom = geom2Eliminate.intersection(selGeom)
-
-                        # We need a common boundary in order to merge
-                        if not iGeom:
-                            continue
-
-                        selValue = None
-                        if mode == self.MODE_BOUNDARY:
-                            selValue = iGeom.length()
-
-                        elif mode == self.MODE_LARGEST_AREA:
-                            selValue = selGeom.area()
-
-                        elif mode == self.MODE_SMALLEST_AREA:
-                            selValue = selGeom.area() * -1
-
-                        else:
-                            raise QgsProcessingException(
-                                self.tr("Invalid value '{0}' for parameter '{1}'").format(mode, self.MODE)
-                            )
-
-                        if selValue is None:
-                            # No candidate found
-                            continue
-
-                        useThis = False
-                        if max is None:
-                            max = selValue
-                            useThis = True
-                        elif selValue > max:
-                            max = selValue
-                            useThis = True
-
-                        if useThis:
-                            mergeWithFid = selFeat.id()
-                            mergeWithGeom = QgsGeometry(selGeom)
-                # End while fit
-
-                if mergeWithFid is None:
-                    featNotEliminated.append(feat)
-                    continue
 
-                # A successful candidate
-                newGeom = mergeWithGeom.combine(geom2Eliminate)
+        # Adjacency between the polygons to eliminate, built once
+        neighbours = self.sliver_neighbours(featToEliminate)
 
-                if processLayer.changeGeometry(mergeWithFid, newGeom):
-                    madeProgress = True
-                else:
-                    raise QgsProcessingException(
-                        self.tr("Could not replace geometry of feature with id {0}").format(mergeWithFid)
-                    )
+        # Work queue of the polygons to eliminate, in the order they were picked up by the
+        # previous passes based implementation. A polygon that can't be merged yet waits until
+        # one of its neighbours is merged: only then a kept polygon may have grown to touch it.
+        queue = deque(range(len(featToEliminate) - 1, -1, -1))
+        waiting = set()
+
+        while queue:
+            if feedback.isCanceled():
+                break
+
+            i = queue.popleft()
+            feat = featToEliminate[i]
+            geom2Eliminate = feat.geometry()
+
+            # Sorted to visit the candidates in the same order as the provider would
+            candidates = sorted(index.intersects(geom2Eliminate.boundingBox()))
+            mergeWithFid = self.best_candidate(geom2Eliminate, candidates, geometries, mode, feedback)
+
+            if mergeWithFid is None:
+                waiting.add(i)
+                continue
+
+            # A successful candidate
+            mergeWithGeom = geometries[mergeWithFid]
+            newGeom = mergeWithGeom.combine(geom2Eliminate)
+
+            self.update_index(index, mergeWithFid, mergeWithGeom, newGeom)
+            geometries[mergeWithFid] = newGeom
+            changedFids.add(mergeWithFid)
 
-                start = start + add
-                feedback.setProgress(start)
+            for j in neighbours[i]:
+                if j in waiting:
+                    waiting.remove(j)
+                    queue.append(j)
 
-            # End for featToEliminate
+            start = start + add
+            feedback.setProgress(start)
 
-            featToEliminate = featNotEliminated
+        featNotEliminated = [featToEliminate[i] for i in sorted(waiting)]
 
-        # End while
-        if not processLayer.commitChanges():
-            raise QgsProcessingException(self.tr("Could not commit changes"))
+        if not provider.changeGeometryValues({fid: geometries[fid] for fid in changedFids}):
+            raise QgsProcessingException(self.tr("Could not replace geometries"))
 
         for feature in featNotEliminated:
             if feedback.isCanceled():
@@ -226,6 +256,183 @@ class MergeByArea(QgisAlgorithm):
 
             print("Error: could not merge feature: {}".format(feature.id()))
 
-            processLayer.dataProvider().addFeature(feature, QgsFeatureSink.FastInsert)
+            provider.addFeature(feature, QgsFeatureSink.FastInsert)
 
         return {self.OUTPUT: dest_id}
+
+    def sliver_neighbours(self, featToEliminate):
+        """Return for every polygon to eliminate the list of the other ones it touches"""
+        sliverIndex = QgsSpatialIndex()
+        for i, feat in enumerate(featToEliminate):
+            sliverIndex.addFeature(i, feat.geometry().boundingBox())
+
+        neighbours = []
+        for i, feat in enumerate(featToEliminate):
+            geom = feat.geometry()
+            engine = QgsGeometry.createGeometryEngine(geom.constGet())
+            engine.prepareGeometry()
+            neighbours.append(
+                [
+                    j
+                    for j in sliverIndex.intersects(geom.boundingBox())
+                    if j != i and engine.intersects(featToEliminate[j].geometry().constGet())
+                ]
+            )
+        return neighbours
+
+    def merge_batched(self, provider, featToEliminate, index, geometries, mode, feedback):
+        """Merge in two phases: first every polygon to eliminate gets a target, then every kept
+        polygon is unioned only once with all the polygons it absorbs.
+
+        A polygon to eliminate touching only other polygons to eliminate is assigned to the best
+        of them, a union-find follows such chains up to the kept polygon at their end."""
+        sliverGeometries = {i: feat.geometry() for i, feat in enumerate(featToEliminate)}
+        neighbours = self.sliver_neighbours(featToEliminate)
+
+        # Union-find over ("kept", fid) and ("sliver", i) nodes, kept polygons are always roots
+        parent = {}
+
+        def find(node):
+            root = node
+            while root in parent:
+                root = parent[root]
+            # Path compression
+            while node in parent and parent[node] != root:
+                parent[node], node = root, parent[node]
+            return root
+
+        # Phase one: assign every polygon to eliminate to a target
+        for i, geom2Eliminate in sliverGeometries.items():
+            if feedback.isCanceled():
+                return
+
+            bbox = geom2Eliminate.boundingBox()
+            target = self.best_candidate(geom2Eliminate, sorted(index.intersects(bbox)), geometries, mode, feedback)
+            if target is not None:
+                targetNode = ("kept", target)
+            else:
+                target = self.best_candidate(geom2Eliminate, sorted(neighbours[i]), sliverGeometries, mode, feedback)
+                if target is None:
+                    continue
+                targetNode = ("sliver", target)
+
+            # Each polygon to eliminate picks its target once, so it is still a root here
+            root = find(targetNode)
+            if root != ("sliver", i):
+                parent[("sliver", i)] = root
+
+            feedback.setProgress(80.0 * (i + 1) / len(sliverGeometries))
+
+        # Phase two: one union per kept polygon, written with a single call
+        absorbed = {}
+        featNotEliminated = []
+        for i, feat in enumerate(featToEliminate):
+            kind, fid = find(("sliver", i))
+            if kind == "kept":
+                absorbed.setdefault(fid, []).append(sliverGeometries[i])
+            else:
+                featNotEliminated.append(feat)
+
+        newGeometries = {
+            fid: QgsGeometry.unaryUnion([geometries[fid]] + sliverGeoms) for fid, sliverGeoms in absorbed.items()
+        }
+
+        if not provider.changeGeometryValues(newGeometries):
+            raise QgsProcessingException(self.tr("Could not replace geometries"))
+
+        if featNotEliminated and not feedback.isCanceled():
+            feedback.pushWarning(
+                self.tr("Could not merge {0} features: {1}").format(
+                    len(featNotEliminated), ", ".join(str(feature.id()) for feature in featNotEliminated)
+                )
+            )
+            provider.addFeatures(featNotEliminated, QgsFeatureSink.FastInsert)
+
+        feedback.setProgress(100)
+
+    def best_candidate(self, geom2Eliminate, candidates, geometries, mode, feedback):
+        """Return the id, among candidates, of the polygon geom2Eliminate should be merged with"""
+        mergeWithFid = None
+        max = None
+
+        # use prepared geometries for faster intersection tests
+        engine = QgsGeometry.createGeometryEngine(geom2Eliminate.constGet())
+        engine.prepareGeometry()
+
+        segments2Eliminate = None
+        if mode == self.MODE_BOUNDARY:
+            segments2Eliminate = boundary_segments(geom2Eliminate)
+            clipBox = geom2Eliminate.boundingBox().buffered(BOUNDARY_CLIP_MARGIN)
+
+        for selFid in candidates:
+            if feedback.isCanceled():
+                break
+
+            selGeom = geometries[selFid]
+
+            if engine.intersects(selGeom.constGet()):
+                selValue = None
+
+                if mode == self.MODE_BOUNDARY:
+                    # Fast path: sum the segments both boundaries share, without any overlay. Only the
+                    # part of the candidate near the polygon to eliminate is hashed, and the sum is only
+                    # trusted when the shared segments are the whole contact between the two: the
+                    # polygons only touch, their interiors don't overlap, and they are fully noded.
+                    selSegments = boundary_segments(selGeom.clipped(clipBox))
+                    sharedLength = sum(
+                        length for segment, length in segments2Eliminate.items() if segment in selSegments
+                    )
+                    if (
+                        sharedLength
+                        and engine.touches(selGeom.constGet())
+                        and fully_noded(segments2Eliminate, selSegments)
+                    ):
+                        selValue = sharedLength
+
+                if not selValue:
+                    # We have a candidate
+                    iGeom = geom2Eliminate.intersection(selGeom)
+
+                    # We need a common boundary in order to merge
+                    if not iGeom:
+                        continue
+
+                    if mode == self.MODE_BOUNDARY:
+                        # Overlapping polygons, or boundaries not (or only partly) noded: a vertex
+                        # of one polygon lies inside a segment of the other
+                        selValue = iGeom.length()
+
+                    elif mode == self.MODE_LARGEST_AREA:
+                        selValue = selGeom.area()
+
+                    elif mode == self.MODE_SMALLEST_AREA:
+                        selValue = selGeom.area() * -1
+
+                    else:
+                        raise QgsProcessingException(
+                            self.tr("Invalid value '{0}' for parameter '{1}'").format(mode, self.MODE)
+                        )
+
+                if selValue is None:
+                    # No candidate found
+                    continue
+
+                useThis = False
+                if max is None:
+                    max = selValue
+                    useThis = True
+                elif selValue > max:
+                    max = selValue
+                    useThis = True
+
+                if useThis:
+                    mergeWithFid = selFid
+
+        return mergeWithFid
+
+    def update_index(self, index, fid, oldGeom, newGeom):
+        # The spatial index removes features by their bounding box
+        oldFeature = QgsFeature(fid)
+        oldFeature.setGeometry(oldGeom)
+        index.deleteFeature(oldFeature)
+        index.addFeature(fid, newGeom.boundingBox())
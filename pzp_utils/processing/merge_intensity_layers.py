@@ -1,32 +1,38 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 from qgis import processing
 from qgis.core import (
     QgsField,
     QgsFields,
     QgsFeature,
+    QgsFeatureRequest,
     QgsWkbTypes,
-    QgsFeatureSink,
     QgsProcessing,
     QgsProcessingAlgorithm,
     QgsProcessingException,
     QgsProcessingParameterCrs,
     QgsProcessingParameterFeatureSource,
-    QgsProcessingParameterField,
+    QgsProcessingParameterMatrix,
+    QgsProcessingParameterMultipleLayers,
     QgsProcessingParameterNumber,
-    QgsProcessingParameterVectorLayer,
     QgsProcessingParameterVectorDestination,
     QgsProcessingParameterFeatureSink,
+    QgsVectorLayerFeatureSource,
 )
 from qgis.PyQt.QtCore import QVariant
 
+from pzp_utils.processing.sink_writer import ChunkedSinkWriter
 
-class MergeIntensityLayers(QgsProcessingAlgorithm):
 
-    NUM_OF_LAYERS = 5
-    LAYERS = [f"LAYER{i}" for i in range(NUM_OF_LAYERS)]
-    INTENSITY_FIELDS = [f"INTENSITY_FIELD{i}" for i in range(NUM_OF_LAYERS)]
-    PERIODS = [f"PERIOD{i}" for i in range(NUM_OF_LAYERS)]
+class MergeIntensityLayers(QgsProcessingAlgorithm):
 
+    LAYERS = "LAYERS"
+    INTENSITY_PERIODS = "INTENSITY_PERIODS"
     CRS = 'CRS'
+    CHUNK_SIZE = "CHUNK_SIZE"
+    THREADS = "THREADS"
     OUTPUT = "OUTPUT"
 
     def createInstance(self):
@@ -49,39 +55,48 @@ class MergeIntensityLayers(QgsProcessingAlgorithm):
 
     def initAlgorithm(self, config=None):
 
-        for i in range(self.NUM_OF_LAYERS):
-            self.addParameter(
-                QgsProcessingParameterVectorLayer(
-                    name=self.LAYERS[i],
-                    description=f"Input layer {i}",
-                    types=[QgsProcessing.TypeVectorPolygon],
-                    optional=True,
-                )
-            )
-
-            self.addParameter(
-                QgsProcessingParameterField(
-                    name=self.INTENSITY_FIELDS[i],
-                    description="Campo contenente le intensità",
-                    parentLayerParameterName=self.LAYERS[i],
-                    type=QgsProcessingParameterField.Numeric,
-                    optional=True,
-                )
+        self.addParameter(
+            QgsProcessingParameterMultipleLayers(
+                name=self.LAYERS,
+                description="Input layers",
+                layerType=QgsProcessing.TypeVectorPolygon,
             )
+        )
 
-            self.addParameter(
-                QgsProcessingParameterNumber(
-                    name=self.PERIODS[i],
-                    description="Periodo di ritorno",
-                    type=QgsProcessingParameterNumber.Integer,
-                    optional=True,
-                )
+        self.addParameter(
+            QgsProcessingParameterMatrix(
+                name=self.INTENSITY_PERIODS,
+                description="Campo contenente le intensità e periodo di ritorno, "
+                "una riga per ogni input layer, nello stesso ordine",
+                headers=["Campo intensità", "Periodo di ritorno"],
+                hasFixedNumberRows=False,
             )
+        )
 
         self.addParameter(QgsProcessingParameterCrs(
             self.CRS, "CRS", defaultValue = "EPSG:2056")
         )
 
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.CHUNK_SIZE,
+                "Numero di elementi scritti per blocco",
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                defaultValue=10000,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.THREADS,
+                "Numero di layer letti in parallelo",
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                defaultValue=4,
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterFeatureSink(self.OUTPUT, "Intensità completo")
         )
@@ -107,34 +122,97 @@ class MergeIntensityLayers(QgsProcessingAlgorithm):
             crs,
         )
 
-        new_features = []
-
-        for i in range(self.NUM_OF_LAYERS):
-            layer = self.parameterAsSource(
-                parameters,
-                self.LAYERS[i],
-                context
-            )
-            if not layer:
-                continue
-
-            intensity_field = self.parameterAsFields(
-                parameters,
-                self.INTENSITY_FIELDS[i],
-                context,
-            )[0]
-
-            period = self.parameterAsInt(
-                parameters,
-                self.PERIODS[i],
-                context,
+        layers = self.parameterAsLayerList(parameters, self.LAYERS, context)
+        intensity_periods = self.parameterAsMatrix(parameters, self.INTENSITY_PERIODS, context)
+        if len(intensity_periods) != 2 * len(layers):
+            raise QgsProcessingException(
+                f"Servono un campo intensità e un periodo di ritorno per ognuno dei {len(layers)} layer"
             )
 
-            for feature in layer.getFeatures():
-                new_feature = QgsFeature()
-                new_feature.setGeometry(feature.geometry())
-                new_feature.setAttributes([feature[intensity_field], period])
-                new_features.append(new_feature)
-
-        sink.addFeatures(new_features, QgsFeatureSink.FastInsert)
+        inputs = []
+        for layer, intensity_field, period in zip(layers, intensity_periods[0::2], intensity_periods[1::2]):
+            intensity_index = layer.fields().lookupField(intensity_field)
+            if intensity_index < 0:
+                raise QgsProcessingException(f'Campo "{intensity_field}" non trovato nel layer {layer.name()}')
+            try:
+                period = float(period)
+            except (TypeError, ValueError):
+                period = None
+            if period is None or not period.is_integer():
+                raise QgsProcessingException(f"Periodo di ritorno non valido per il layer {layer.name()}")
+            inputs.append((layer, intensity_index, int(period)))
+
+        chunk_size = self.parameterAsInt(parameters, self.CHUNK_SIZE, context)
+        threads = self.parameterAsInt(parameters, self.THREADS, context)
+        writer = ChunkedSinkWriter(sink, chunk_size, feedback, sum(layer.featureCount() for layer, _, _ in inputs))
+
+        # The layers are read by a pool of threads, while only this thread writes to the sink
+        batches = queue.Queue(maxsize=2 * threads)
+        canceled = threading.Event()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            futures = [
+                pool.submit(
+                    read_layer,
+                    # the feature source is the thread safe way to read a layer from another thread
+                    QgsVectorLayerFeatureSource(layer),
+                    intensity_index,
+                    period,
+                    chunk_size,
+                    batches,
+                    canceled,
+                )
+                for layer, intensity_index, period in inputs
+            ]
+
+            # Every reader puts None on the queue when it's done
+            remaining = len(futures)
+            try:
+                while remaining:
+                    batch = batches.get()
+                    if batch is None:
+                        remaining -= 1
+                        continue
+                    if canceled.is_set():
+                        continue
+
+                    for feature in batch:
+                        if not writer.addFeature(feature):
+                            canceled.set()
+                            break
+            finally:
+                # Stop the readers and drain the queue, so none is left blocked on it and the pool can
+                # shut down, also when writing failed
+                canceled.set()
+                while remaining:
+                    if batches.get() is None:
+                        remaining -= 1
+
+            for future in futures:
+                future.result()
+
+        writer.flush()
         return {self.OUTPUT: dest_id}
+
+
+def read_layer(source, intensity_index, period, batch_size, batches, canceled):
+    """Read a layer in a worker thread and put its features, with the intensity and the period
+    as attributes, on the batches queue"""
+    try:
+        request = QgsFeatureRequest().setSubsetOfAttributes([intensity_index])
+        batch = []
+        for feature in source.getFeatures(request):
+            if canceled.is_set():
+                break
+
+            new_feature = QgsFeature()
+            new_feature.setGeometry(feature.geometry())
+            new_feature.setAttributes([feature.attributes()[intensity_index], period])
+            batch.append(new_feature)
+            if len(batch) >= batch_size:
+                batches.put(batch)
+                batch = []
+
+        if batch:
+            batches.put(batch)
+    finally:
+        batches.put(None)
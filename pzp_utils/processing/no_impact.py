@@ -3,6 +3,7 @@ from collections import OrderedDict
 from qgis import processing
 from qgis.core import (
     QgsFeature,
+    QgsFeatureRequest,
     QgsFeatureSink,
     QgsField,
     QgsFields,
@@ -19,6 +20,7 @@ from qgis.core import (
 from qgis.PyQt.QtCore import QVariant
 
 from . import domains
+from .partition import features_to_layer, partition_layers
 
 
 class NoImpact(QgsProcessingAlgorithm):
@@ -149,11 +151,20 @@ class NoImpact(QgsProcessingAlgorithm):
             intensity_field_idx = one_feature.fieldNameIndex(intensity_field)
             process_source_field_idx = one_feature.fieldNameIndex(intensity_process_source_field)
 
-        for feature in source.getFeatures():
-            used_periods.add(feature[period_field])
-            process_sources.add(feature[intensity_process_source_field])
+        # The NoImpact features take the other attributes of the last intensity feature, only the
+        # attributes are read to find it
+        for feature in source.getFeatures(QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)):
             attributes = feature.attributes()
 
+        # Read both layers only once, grouped by (process source, period) and by process source
+        intensity_groups = partition_layers(source, [intensity_process_source_field, period_field], feedback=feedback)
+        area_source = self.parameterAsSource(parameters, self.AREA_LAYER, context)
+        area_groups = partition_layers(area_source, [area_process_source_field], feedback=feedback)
+
+        for process_source, period in intensity_groups.keys():
+            used_periods.add(period)
+            process_sources.add(process_source)
+
         used_periods = sorted(used_periods, reverse=False)
 
         feedback.pushInfo(f"Used periods {used_periods}")
@@ -169,40 +180,22 @@ class NoImpact(QgsProcessingAlgorithm):
         )
 
         for process_source in process_sources:
+            area = area_groups.get((process_source,))
 
-            # Escape ' in process_source
-            process_source = process_source.replace("'", "''")
+            # Without an area there is nothing to subtract from
+            if area is None:
+                continue
 
             for period in used_periods:
-                result = processing.run(
-                    "native:extractbyexpression",
-                    {
-                        "INPUT": parameters[self.INTENSITY_LAYER],
-                        "EXPRESSION": f'"{period_field}" = {period} AND "{intensity_process_source_field}" = \'{process_source}\'',
-                        "OUTPUT": "memory:",
-                    },
-                    context=context,
-                    feedback=feedback,
-                    is_child_algorithm=True,
-                )
-
-                area = processing.run(
-                    "native:extractbyexpression",
-                    {
-                        "INPUT": parameters[self.AREA_LAYER],
-                        "EXPRESSION": f'"{area_process_source_field}" = \'{process_source}\'',
-                        "OUTPUT": "memory:",
-                    },
-                    context=context,
-                    feedback=feedback,
-                    is_child_algorithm=True,
-                )
+                intensity = intensity_groups.get((process_source, period))
+                if intensity is None:
+                    intensity = features_to_layer([], source.fields(), source.wkbType(), source.sourceCrs())
 
                 result = processing.run(
                     "native:difference",
                     {
-                        'INPUT': area["OUTPUT"],
-                        'OVERLAY': result["OUTPUT"],
+                        'INPUT': area,
+                        'OVERLAY': intensity,
                         'OUTPUT': "memory:",
                         'GRID_SIZE':None,
                     },
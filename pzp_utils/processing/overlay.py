@@ -0,0 +1,44 @@
+from qgis.core import QgsFeature, QgsGeometry, QgsSpatialIndex
+
+
+def difference(layer, overlay_layer, feedback=None):
+    """Features of layer clipped by the polygons of overlay_layer, like native:difference.
+
+    The overlay polygons intersecting a feature are found with a spatial index and tested
+    with a prepared geometry, then the feature is clipped by their union in one difference.
+    Returns the clipped features, with their attributes, without the ones that are
+    completely covered.
+    """
+    index = QgsSpatialIndex()
+    overlay = {}
+    for feature in overlay_layer.getFeatures():
+        if feature.hasGeometry():
+            overlay[feature.id()] = feature.geometry()
+            index.addFeature(feature.id(), feature.geometry().boundingBox())
+
+    result = []
+    for feature in layer.getFeatures():
+        if feedback and feedback.isCanceled():
+            break
+
+        geometry = feature.geometry()
+        if geometry.isEmpty():
+            continue
+
+        # use prepared geometries for faster intersection tests
+        engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+        engine.prepareGeometry()
+
+        overlapping = [
+            overlay[fid] for fid in index.intersects(geometry.boundingBox()) if engine.intersects(overlay[fid].constGet())
+        ]
+        if overlapping:
+            geometry = geometry.difference(QgsGeometry.unaryUnion(overlapping))
+            if geometry.isEmpty():
+                continue
+
+        clipped = QgsFeature(feature)
+        clipped.setGeometry(geometry)
+        result.append(clipped)
+
+    return result
@@ -0,0 +1,121 @@
+"""
+Helpers to run work on a pool of worker processes.
+
+QGIS objects can't be pickled, so features travel between processes as
+(WKB, attributes) tuples and fields as (name, type) tuples.
+"""
+
+import multiprocessing
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from qgis.core import NULL, QgsApplication, QgsFeature, QgsField, QgsFields, QgsGeometry
+from qgis.PyQt.QtCore import QVariant
+
+_qgis_app = None
+
+
+def python_executable():
+    # In QGIS sys.executable is the QGIS binary and not a Python interpreter
+    if os.path.basename(sys.executable).lower().startswith("python"):
+        return sys.executable
+
+    for folder in (os.path.join(sys.exec_prefix, "bin"), sys.exec_prefix):
+        for name in ("python3", "python3.exe", "python.exe", "python"):
+            path = os.path.join(folder, name)
+            if os.path.isfile(path):
+                return path
+
+    return sys.executable
+
+
+def process_pool(workers, init_processing=False):
+    """Return a ProcessPoolExecutor with workers spawned from a plain Python interpreter.
+
+    With init_processing, each worker starts a headless QGIS with the processing
+    framework and this provider, so it can run processing.run()."""
+    mp_context = multiprocessing.get_context("spawn")
+    mp_context.set_executable(python_executable())
+
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=mp_context,
+        initializer=init_worker,
+        initargs=(QgsApplication.prefixPath(), init_processing),
+    )
+
+
+def init_worker(prefix_path, init_processing):
+    global _qgis_app
+
+    QgsApplication.setPrefixPath(prefix_path, True)
+    _qgis_app = QgsApplication([], False)
+    _qgis_app.initQgis()
+
+    if init_processing:
+        from processing.core.Processing import Processing
+
+        from pzp_utils.processing.provider import Provider
+
+        Processing.initialize()
+        QgsApplication.processingRegistry().addProvider(Provider())
+
+
+def submit_in_order(pool, fn, tasks, window):
+    """Submit fn(*args) for every (item, args) of tasks, with at most window tasks in flight,
+    and yield (item, result) in the same order as tasks. item stays in this process."""
+    pending = deque()
+    for item, args in tasks:
+        pending.append((item, pool.submit(fn, *args)))
+        if len(pending) >= window:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def fields_to_tuples(fields):
+    return [(field.name(), int(field.type())) for field in fields]
+
+
+def tuples_to_fields(field_tuples):
+    fields = QgsFields()
+    for name, field_type in field_tuples:
+        fields.append(QgsField(name, QVariant.Type(field_type)))
+    return fields
+
+
+def features_to_tuples(features):
+    return [
+        (
+            bytes(feature.geometry().asWkb()),
+            [None if value == NULL else value for value in feature.attributes()],
+        )
+        for feature in features
+    ]
+
+
+def tuples_to_features(feature_tuples, fields):
+    features = []
+    for wkb, attributes in feature_tuples:
+        feature = QgsFeature(fields)
+        geometry = QgsGeometry()
+        geometry.fromWkb(wkb)
+        feature.setGeometry(geometry)
+        feature.setAttributes(attributes)
+        features.append(feature)
+    return features
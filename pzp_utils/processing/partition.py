@@ -0,0 +1,43 @@
+from collections import defaultdict
+
+from qgis.core import NULL, QgsFeatureRequest, QgsMemoryProviderUtils
+
+
+def partition_features(source, key_fields, request=None, feedback=None):
+    """Read the source once and group its features by the values of key_fields.
+
+    Returns an ordinary dict { (value, value, ...): [feature, ...] }. Features with a
+    NULL in one of the key fields are skipped, like an `"field" = value` expression would.
+    """
+    field_indices = [source.fields().lookupField(field) for field in key_fields]
+    if request is None:
+        request = QgsFeatureRequest()
+
+    groups = defaultdict(list)
+    for feature in source.getFeatures(request):
+        if feedback and feedback.isCanceled():
+            break
+
+        attributes = feature.attributes()
+        key = tuple(attributes[idx] for idx in field_indices)
+        if any(value is None or value == NULL for value in key):
+            continue
+        groups[key].append(feature)
+
+    return dict(groups)
+
+
+def partition_layers(source, key_fields, request=None, feedback=None, name="partition"):
+    """Same as partition_features but returns one memory layer per key, ready to be
+    passed as INPUT to child algorithms."""
+    groups = partition_features(source, key_fields, request, feedback)
+    return {
+        key: features_to_layer(features, source.fields(), source.wkbType(), source.sourceCrs(), name)
+        for key, features in groups.items()
+    }
+
+
+def features_to_layer(features, fields, wkb_type, crs, name="partition"):
+    layer = QgsMemoryProviderUtils.createMemoryLayer(name, fields, wkb_type, crs)
+    layer.dataProvider().addFeatures(features)
+    return layer
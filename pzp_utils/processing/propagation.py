@@ -5,16 +5,19 @@ from qgis.core import (
     QgsField,
     QgsFields,
     QgsFeature,
+    QgsGeometry,
     QgsGeometryUtils,
     QgsProcessing,
     QgsProcessingAlgorithm,
     QgsProcessingException,
+    QgsProcessingParameterBoolean,
     QgsProcessingParameterFeatureSource,
     QgsProcessingParameterField,
     QgsProcessingParameterFeatureSink,
 )
 from qgis.PyQt.QtCore import QVariant
 from . import domains
+from .partition import features_to_layer, partition_features
 
 class Propagation(QgsProcessingAlgorithm):
 
@@ -25,8 +28,12 @@ class Propagation(QgsProcessingAlgorithm):
     PROPAGATION_FIELD = "PROPAGATION_FIELD"
     BREAKING_FIELD_PROP = "BREAKING_FIELD_PROP"
     SOURCE_FIELD_PROP = "SOURCE_FIELD_PROP"
+    SPLIT_ONCE = "SPLIT_ONCE"
     OUTPUT = "OUTPUT"
 
+    # Width of the buffer used to decide if a polygon is on the left of a line
+    LEFT_BUFFER_DISTANCE = 1000000
+
     def createInstance(self):
         return Propagation()
 
@@ -43,7 +50,12 @@ class Propagation(QgsProcessingAlgorithm):
         return "algorithms"
 
     def shortHelpString(self):
-        return "Algoritmo per calcolare le probabilità di accadimento in base alle linee di propagazione"
+        return (
+            "Algoritmo per calcolare le probabilità di accadimento in base alle linee di propagazione.\n\n"
+            "Con la divisione unica per fonte i poligoni vengono divisi anche dalle linee delle altre "
+            "probabilità di rottura: i frammenti possono essere assegnati a un'altra linea e ricevere "
+            "un'altra probabilità di propagazione rispetto al metodo predefinito."
+        )
 
     def initAlgorithm(self, config=None):
         self.addParameter(
@@ -107,6 +119,20 @@ class Propagation(QgsProcessingAlgorithm):
             )
         )
 
+        split_once = QgsProcessingParameterBoolean(
+            self.SPLIT_ONCE,
+            "Dividi i poligoni di ogni fonte una sola volta con tutte le linee di propagazione "
+            "(più veloce, ma può cambiare i risultati)",
+            defaultValue=False,
+        )
+        split_once.setHelp(
+            "I poligoni vengono divisi anche dalle linee delle altre probabilità di rottura della stessa fonte. "
+            "Oltre a produrre più frammenti, questo può cambiare la linea a cui un frammento viene assegnato "
+            "e quindi la probabilità di propagazione che riceve, rispetto alla divisione per ogni probabilità "
+            "di rottura."
+        )
+        self.addParameter(split_once)
+
         self.addParameter(QgsProcessingParameterFeatureSink(
             self.OUTPUT, "Output layer"))
 
@@ -140,6 +166,8 @@ class Propagation(QgsProcessingAlgorithm):
             context,
         )[0]
 
+        split_once = self.parameterAsBool(parameters, self.SPLIT_ONCE, context)
+
         breaking_field_idx = -1
         one_feature = next(breaking_layer.getFeatures())
         if one_feature:
@@ -162,11 +190,17 @@ class Propagation(QgsProcessingAlgorithm):
             breaking_layer.sourceCrs(),
         )
 
+        # Read both layers only once, grouped by (source, breaking value)
+        breaking_groups = partition_features(breaking_layer, [source_field, breaking_field], feedback=feedback)
+        propagation_groups = partition_features(
+            propagation_layer, [source_field_prop, breaking_field_prop], feedback=feedback
+        )
+
         used_breaking_values = set()
         used_source_values = set()
-        for feature in breaking_layer.getFeatures():
-            used_breaking_values.add(feature[breaking_field])
-            used_source_values.add(feature[source_field])
+        for source_value, breaking_value in breaking_groups.keys():
+            used_breaking_values.add(breaking_value)
+            used_source_values.add(source_value)
 
         used_breaking_values = sorted(used_breaking_values, reverse=True)
 
@@ -174,79 +208,178 @@ class Propagation(QgsProcessingAlgorithm):
         feedback.pushInfo(f"Used source values {used_source_values}")
 
         for source_value in used_source_values:
-            for breaking_value in used_breaking_values:
-                subset_breaking = processing.run(
-                    "native:extractbyexpression",
+            if split_once:
+                faces = self.split_source_once(
                     {
-                        "INPUT": parameters[self.BREAKING_LAYER],
-                        "EXPRESSION": f'"{breaking_field}" = {breaking_value} AND "{source_field}" = \'{source_value}\'',
-                        "OUTPUT": "memory:",
+                        breaking_value: (
+                            breaking_groups.get((source_value, breaking_value)),
+                            propagation_groups.get((source_value, breaking_value)),
+                        )
+                        for breaking_value in used_breaking_values
                     },
-                    context=context,
-                    feedback=feedback,
-                    # is_child_algorithm=True,
+                    breaking_layer,
+                    propagation_layer,
+                    context,
+                    feedback,
                 )
 
-                subset_propagation = processing.run(
-                    "native:extractbyexpression",
-                    {
-                        "INPUT": parameters[self.PROPAGATION_LAYER],
-                        "EXPRESSION": f'"{breaking_field_prop}" = {breaking_value} AND "{source_field_prop}" = \'{source_value}\'',
-                        "OUTPUT": "memory:",
-                    },
-                    context=context,
-                    feedback=feedback,
-                    # is_child_algorithm=True,
-                )
+            for breaking_value in used_breaking_values:
+                breaking_features = breaking_groups.get((source_value, breaking_value))
+                propagation_features = propagation_groups.get((source_value, breaking_value))
 
-                result = processing.run(
-                    "native:splitwithlines",
-                    {
-                        'INPUT': subset_breaking["OUTPUT"],
-                        'LINES': subset_propagation["OUTPUT"],
-                        'OUTPUT': "memory:",
-                    },
-                    context=context,
-                    feedback=feedback,
-                    # is_child_algorithm=True,
-                )
+                # Nothing would be assigned without polygons or without lines
+                if not breaking_features or not propagation_features:
+                    continue
 
-                lines = list(subset_propagation["OUTPUT"].getFeatures())
-                lines = sorted(lines, key=lambda line: -line[propagation_field])
-                features_to_add = []
-                already_added_polygons = []
+                if split_once:
+                    polygons = faces[breaking_value]
+                else:
+                    polygons = self.split(
+                        breaking_features, propagation_features, breaking_layer, propagation_layer, context, feedback
+                    )
 
-                for line in lines:
-                    for polygon in result["OUTPUT"].getFeatures():
-                        if polygon in already_added_polygons:
-                            continue
+                lines = sorted(propagation_features, key=lambda line: -line[propagation_field])
+                assignments = self.assign_polygons(polygons, lines)
 
-                        left = self.left_of_line(polygon, line)
-                        if left == False:
-                            new_feature = QgsFeature(fields)
-                            new_feature.setGeometry(polygon.geometry())
-                            attributes = polygon.attributes()
+                features_to_add = []
+                for polygon, line in assignments:
+                    new_feature = QgsFeature(fields)
+                    new_feature.setGeometry(polygon.geometry())
+                    attributes = polygon.attributes()
 
-                            breaking_probability = polygon.attributes()[breaking_field_idx]
-                            propagation_probability = line.attributes()[propagation_field_idx]
+                    breaking_probability = polygon.attributes()[breaking_field_idx]
+                    propagation_probability = line.attributes()[propagation_field_idx]
 
-                            acca_prob = domains.MATRIX_BREAKING[propagation_probability][breaking_probability]
+                    acca_prob = domains.MATRIX_BREAKING[propagation_probability][breaking_probability]
 
-                            print(f"{breaking_probability=}, {propagation_probability=}, {acca_prob=}")
-                            attributes.append(acca_prob)
-                            new_feature.setAttributes(attributes)
-                            features_to_add.append(new_feature)
-                            already_added_polygons.append(polygon)
+                    print(f"{breaking_probability=}, {propagation_probability=}, {acca_prob=}")
+                    attributes.append(acca_prob)
+                    new_feature.setAttributes(attributes)
+                    features_to_add.append(new_feature)
 
                 sink.addFeatures(features_to_add)
         return {self.OUTPUT: dest_id}
 
-    def left_of_line(self, poly, line):
-        # Expand the line on the left side and check if a point in the polygon is inside the buffer
+    def split(self, breaking_features, propagation_features, breaking_layer, propagation_layer, context, feedback):
+        subset_breaking = features_to_layer(
+            breaking_features, breaking_layer.fields(), breaking_layer.wkbType(), breaking_layer.sourceCrs()
+        )
+        subset_propagation = features_to_layer(
+            propagation_features,
+            propagation_layer.fields(),
+            propagation_layer.wkbType(),
+            propagation_layer.sourceCrs(),
+        )
+
+        result = processing.run(
+            "native:splitwithlines",
+            {
+                'INPUT': subset_breaking,
+                'LINES': subset_propagation,
+                'OUTPUT': "memory:",
+            },
+            context=context,
+            feedback=feedback,
+            # is_child_algorithm=True,
+        )
+        return list(result["OUTPUT"].getFeatures())
+
+    def split_source_once(self, groups, breaking_layer, propagation_layer, context, feedback):
+        """Split all the breaking polygons of a source by all of its propagation lines with a
+        single split and return the faces labelled per breaking value.
+
+        groups is a dict { breaking_value: (breaking_features, propagation_features) }, the
+        result a dict { breaking_value: [face, ...] } where every face carries the attributes
+        of the breaking polygon it comes from."""
+
+        # Identical footprints shared by several breaking values are split only once
+        footprints = {}
+        all_lines = []
+        for breaking_value, (breaking_features, propagation_features) in groups.items():
+            if not breaking_features or not propagation_features:
+                continue
+            all_lines.extend(propagation_features)
+            for feature in breaking_features:
+                footprints.setdefault(bytes(feature.geometry().asWkb()), []).append((breaking_value, feature))
+
+        faces = {breaking_value: [] for breaking_value in groups.keys()}
+        if not footprints:
+            return faces
+
+        footprint_fields = QgsFields()
+        footprint_fields.append(QgsField("footprint", QVariant.Int))
+        footprint_features = []
+        labels = []
+        for footprint_idx, labelled_features in enumerate(footprints.values()):
+            footprint = QgsFeature(footprint_fields)
+            footprint.setGeometry(labelled_features[0][1].geometry())
+            footprint.setAttributes([footprint_idx])
+            footprint_features.append(footprint)
+            labels.append(labelled_features)
+
+        result = processing.run(
+            "native:splitwithlines",
+            {
+                'INPUT': features_to_layer(
+                    footprint_features, footprint_fields, breaking_layer.wkbType(), breaking_layer.sourceCrs()
+                ),
+                'LINES': features_to_layer(
+                    all_lines, propagation_layer.fields(), propagation_layer.wkbType(), propagation_layer.sourceCrs()
+                ),
+                'OUTPUT': "memory:",
+            },
+            context=context,
+            feedback=feedback,
+            # is_child_algorithm=True,
+        )
+
+        face_id = 0
+        for split_feature in result["OUTPUT"].getFeatures():
+            for breaking_value, feature in labels[split_feature["footprint"]]:
+                face = QgsFeature(feature)
+                face.setId(face_id)
+                face.setGeometry(split_feature.geometry())
+                faces[breaking_value].append(face)
+                face_id += 1
+
+        return faces
+
+    def assign_polygons(self, polygons, lines):
+        """Assign every polygon to the first line (in the given order) it is not on the left of.
+
+        Returns a list of (polygon, line) tuples in the same order as the nested
+        line/polygon loops would produce them."""
+        # Polygons still waiting for a line, keyed by fid (dicts keep the layer order). The left side
+        # buffer is LEFT_BUFFER_DISTANCE wide, so it covers the whole layer and a spatial index
+        # wouldn't rule out any polygon: every remaining polygon is tested against every line.
+        remaining = {polygon.id(): polygon for polygon in polygons}
+        points = {polygon.id(): polygon.geometry().pointOnSurface() for polygon in polygons}
+        assignments = []
+
+        for line in lines:
+            if not remaining:
+                break
+
+            # The left side is built and prepared once per line, each polygon then
+            # only needs a point in polygon test
+            left_side = self.left_side(line)
+            left_side_engine = QgsGeometry.createGeometryEngine(left_side.constGet())
+            left_side_engine.prepareGeometry()
+
+            for fid in list(remaining):
+                if left_side_engine.contains(points[fid].constGet()):
+                    continue
+
+                assignments.append((remaining[fid], line))
+                del remaining[fid]
+
+        return assignments
+
+    def left_side(self, line):
+        # Expand the line on the left side, a polygon is on the left if a point of it is inside the buffer
 
         # singleSidedBuffer changed from QGIS 3.16 to 3.22 (the side args is not an int anymore)
         try:
-            buf = line.geometry().singleSidedBuffer(1000000, 4, Qgis.BufferSide.Left)
+            return line.geometry().singleSidedBuffer(self.LEFT_BUFFER_DISTANCE, 4, Qgis.BufferSide.Left)
         except:
-            buf = line.geometry().singleSidedBuffer(1000000, 4, 0)
-        return buf.contains(poly.geometry().pointOnSurface())
+            return line.geometry().singleSidedBuffer(self.LEFT_BUFFER_DISTANCE, 4, 0)
@@ -20,13 +20,20 @@ Derived from:
 
 import os
 
+from osgeo import ogr
 from processing.algs.qgis.QgisAlgorithm import QgisAlgorithm
 from qgis.core import (
+    QgsDataSourceUri,
     QgsFeatureSink,
     QgsProcessing,
     QgsProcessingException,
+    QgsProcessingFeatureSource,
+    QgsProcessingFeatureSourceDefinition,
     QgsProcessingParameterFeatureSink,
     QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterNumber,
+    QgsProviderRegistry,
+    QgsVectorLayer,
 )
 
 pluginPath = os.path.split(os.path.split(os.path.dirname(__file__))[0])[0]
@@ -34,6 +41,7 @@ pluginPath = os.path.split(os.path.split(os.path.dirname(__file__))[0])[0]
 
 class RemoveByArea(QgisAlgorithm):
     INPUT = "INPUT"
+    MIN_AREA = "MIN_AREA"
     OUTPUT = "OUTPUT"
 
     def group(self):
@@ -50,6 +58,16 @@ class RemoveByArea(QgisAlgorithm):
             QgsProcessingParameterFeatureSource(self.INPUT, self.tr("Input layer"), [QgsProcessing.TypeVectorPolygon])
         )
 
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MIN_AREA,
+                self.tr("Remove polygons with an area smaller than or equal to"),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                defaultValue=1,
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr("Eliminated"), QgsProcessing.TypeVectorPolygon)
         )
@@ -69,17 +87,90 @@ class RemoveByArea(QgisAlgorithm):
         if sink is None:
             raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
 
-        for feature in inLayer.getFeatures():
-            if feedback.isCanceled():
-                break
-
-            if feature.geometry().area() <= 1:
-                print(f"Remove feature: {feature.attributes()}")
-                continue
-
-            # write the others to output
-            sink.addFeature(feature, QgsFeatureSink.FastInsert)
+        minArea = self.parameterAsDouble(parameters, self.MIN_AREA, context)
+
+        # Let the database drop the small polygons when it can, otherwise check them here. Only a
+        # plain layer can be filtered: selection, feature limit and filter are applied by inLayer
+        filteredLayer = None
+        definition = parameters[self.INPUT]
+        if not isinstance(definition, QgsProcessingFeatureSourceDefinition) or not (
+            definition.selectedFeaturesOnly
+            or definition.featureLimit != -1
+            or getattr(definition, "filterExpression", "")
+            or definition.flags & QgsProcessingFeatureSourceDefinition.FlagOverrideDefaultGeometryCheck
+        ):
+            filteredLayer = self.filtered_layer(self.parameterAsVectorLayer(parameters, self.INPUT, context), minArea)
+
+        total = inLayer.featureCount()
+        kept = 0
+        if filteredLayer is not None:
+            feedback.pushInfo(self.tr("Area filter: {0}").format(filteredLayer.subsetString()))
+            # Read through a processing source, so the invalid geometries are handled as the context says
+            filteredSource = QgsProcessingFeatureSource(filteredLayer, context)
+            for feature in filteredSource.getFeatures():
+                if feedback.isCanceled():
+                    break
+
+                sink.addFeature(feature, QgsFeatureSink.FastInsert)
+                kept += 1
+        else:
+            for feature in inLayer.getFeatures():
+                if feedback.isCanceled():
+                    break
+
+                if feature.geometry().area() <= minArea:
+                    continue
+
+                # write the others to output
+                sink.addFeature(feature, QgsFeatureSink.FastInsert)
+                kept += 1
 
         del sink
 
+        if total >= 0:
+            feedback.pushInfo(self.tr("Removed {0} of {1} features").format(total - kept, total))
+
         return {self.OUTPUT: dest_id}
+
+    def filtered_layer(self, layer, minArea):
+        """Return a new layer on the same table with the area filter in its subset string, None
+        when the provider can't evaluate it"""
+        if layer is None:
+            return None
+
+        if layer.providerType() == "postgres":
+            geometryColumn = QgsDataSourceUri(layer.source()).geometryColumn()
+
+        elif layer.providerType() == "ogr":
+            uriParts = QgsProviderRegistry.instance().decodeUri("ogr", layer.source())
+            path = uriParts.get("path", "")
+            if not path.lower().endswith(".gpkg"):
+                return None
+
+            dataSource = ogr.Open(path)
+            if dataSource is None:
+                return None
+            if uriParts.get("layerName"):
+                ogrLayer = dataSource.GetLayerByName(uriParts["layerName"])
+            else:
+                ogrLayer = dataSource.GetLayer(0)
+            if ogrLayer is None:
+                return None
+            geometryColumn = ogrLayer.GetGeometryColumn()
+
+        else:
+            return None
+
+        if not geometryColumn:
+            return None
+
+        subset = 'ST_Area("{0}") > {1}'.format(geometryColumn.replace('"', '""'), minArea)
+        if layer.subsetString():
+            subset = "({0}) AND {1}".format(layer.subsetString(), subset)
+
+        filteredLayer = QgsVectorLayer(layer.source(), layer.name(), layer.providerType())
+        # ST_Area may not be available (e.g. GeoPackage without SpatiaLite), then the subset is refused
+        if not filteredLayer.isValid() or not filteredLayer.setSubsetString(subset):
+            return None
+
+        return filteredLayer
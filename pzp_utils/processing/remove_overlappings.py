@@ -1,5 +1,6 @@
 from qgis import processing
 from qgis.core import (
+    QgsFeatureSink,
     QgsField,
     QgsFields,
     QgsProcessing,
@@ -9,9 +10,12 @@ from qgis.core import (
     QgsProcessingParameterField,
     QgsProcessingParameterFeatureSink,
     QgsApplication,
+    QgsProcessingUtils,
 )
 from qgis.PyQt.QtCore import QVariant
 
+from pzp_utils.processing.partition import partition_layers
+
 
 class RemoveOverlappings(QgsProcessingAlgorithm):
 
@@ -103,65 +107,70 @@ class RemoveOverlappings(QgsProcessingAlgorithm):
             context,
         )[0]
 
+        # Read the input only once, grouped by (source, period, intensity)
+        groups = partition_layers(source, [source_field, period_field, intensity_field], feedback=feedback)
+
         intensities = set()
         periods = set()
         sources = set()
 
-        for feature in source.getFeatures():
-            intensities.add(feature[intensity_field])
-            periods.add(feature[period_field])
-            sources.add(feature[source_field])
+        for source_value, period, intensity in groups.keys():
+            intensities.add(intensity)
+            periods.add(period)
+            sources.add(source_value)
 
         intensities = sorted(intensities, reverse=True)
         periods = sorted(periods, reverse=True)
 
-        final_layer = None
-        for source in sources:
+        # Every period is streamed straight into the output sink, so the features computed
+        # so far are not copied again for every period
+        sink = None
+        dest_id = None
+        for source_value in sources:
             for period in periods:
+                intensity_layers = {
+                    intensity: groups[(source_value, period, intensity)]
+                    for intensity in intensities
+                    if (source_value, period, intensity) in groups
+                }
+                if not intensity_layers:
+                    continue
+
                 result = self.prepare_period(
-                    intensities,
+                    intensity_layers,
                     intensity_field,
-                    period,
-                    period_field,
-                    source,
-                    source_field,
-                    parameters,
                     context,
                     feedback)
-                if final_layer:
-                    result = processing.run(
-                        "native:mergevectorlayers",
-                        {
-                            "LAYERS": [result["OUTPUT"], final_layer],
-                            "OUTPUT": "memory:",
-                        },
-                        context=context,
-                        feedback=feedback,
-                        is_child_algorithm=True,
+
+                layer = QgsProcessingUtils.mapLayerFromString(result["OUTPUT"], context)
+                if sink is None:
+                    (sink, dest_id) = self.parameterAsSink(
+                        parameters,
+                        self.OUTPUT,
+                        context,
+                        layer.fields(),
+                        layer.wkbType(),
+                        layer.crs(),
                     )
-                final_layer = result["OUTPUT"]
+                    if sink is None:
+                        raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+
+                for feature in layer.getFeatures():
+                    sink.addFeature(feature, QgsFeatureSink.FastInsert)
 
-        return {self.OUTPUT: final_layer}
+                context.temporaryLayerStore().removeMapLayer(layer)
 
-    def prepare_period(self, intensities, intensity_field, period, period_field, source, source_field, parameters, context, feedback):
+        return {self.OUTPUT: dest_id}
+
+    def prepare_period(self, intensity_layers, intensity_field, context, feedback):
+        """intensity_layers is a dict { intensity: layer } ordered by intensity, highest first"""
 
         final_layer = None
-        for intensity in intensities:
-            result = processing.run(
-                "native:extractbyexpression",
-                {
-                    "INPUT": parameters[self.INPUT],
-                    "EXPRESSION": f'"{intensity_field}" = {intensity} AND "{period_field}" = \'{period}\' AND "{source_field}" = \'{source}\'',
-                    "OUTPUT": "memory:",
-                },
-                context=context,
-                feedback=feedback,
-                is_child_algorithm=True,
-            )
+        for intensity, intensity_layer in intensity_layers.items():
             result = processing.run(
                 "native:dissolve",
                 {
-                    "INPUT": result["OUTPUT"],
+                    "INPUT": intensity_layer,
                     "FIELD": f"{intensity_field}",
                     "SEPARATE_DISJOINT": True,
                     "OUTPUT": "memory:",
@@ -259,7 +268,7 @@ class RemoveOverlappings(QgsProcessingAlgorithm):
             deletecolumn_id,
             {'INPUT': result["OUTPUT"],
              'COLUMN':['fid', 'layer', 'path'],
-             "OUTPUT": parameters[self.OUTPUT],
+             "OUTPUT": "memory:",
              },
             context=context,
             feedback=feedback,
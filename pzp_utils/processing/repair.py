@@ -0,0 +1,154 @@
+"""
+Per-feature geometry repair, the same steps as the native:fixgeometries,
+native:snappointstogrid and native:buffer child algorithms but applied to
+a single geometry, so several steps can run in one pass over the features.
+"""
+
+import hashlib
+
+from qgis.core import Qgis, QgsFeatureRequest, QgsGeometry, QgsWkbTypes
+
+GRID_SPACING = 0.001
+BUFFER_DISTANCE = 1e-06
+BUFFER_SEGMENTS = 5
+BUFFER_MITER_LIMIT = 2
+
+# Buffer styles moved from QgsGeometry to Qgis in QGIS 3.30
+try:
+    BUFFER_END_CAP_STYLE = Qgis.EndCapStyle.Round
+    BUFFER_JOIN_STYLE = Qgis.JoinStyle.Round
+except AttributeError:
+    BUFFER_END_CAP_STYLE = QgsGeometry.CapRound
+    BUFFER_JOIN_STYLE = QgsGeometry.JoinStyleRound
+
+# native:fixgeometries repairs with the Structure method, its default since QGIS 3.28 when GEOS 3.10 or
+# later is available. Before that it used the Linework method, the makeValid default.
+try:
+    MAKE_VALID_METHOD = Qgis.MakeValidMethod.Structure if Qgis.geosVersionInt() >= 31000 else None
+except AttributeError:
+    MAKE_VALID_METHOD = None
+
+# GEOS validity of the geometries already checked, by hash of their WKB
+VALIDITY_CACHE_SIZE = 100000
+_validity_cache = {}
+
+
+def is_valid(geometry):
+    """GEOS validity, cached by geometry content so the same geometry going through several
+    repair steps or runs is only checked once"""
+    key = hashlib.blake2b(geometry.asWkb(), digest_size=16).digest()
+    valid = _validity_cache.get(key)
+    if valid is None:
+        valid = geometry.isGeosValid()
+        if len(_validity_cache) >= VALIDITY_CACHE_SIZE:
+            _validity_cache.clear()
+        _validity_cache[key] = valid
+    return valid
+
+
+def needs_repair(geometry):
+    # Collections are always repaired, makeValid is what drops their non polygon parts
+    if QgsWkbTypes.flatType(geometry.wkbType()) == QgsWkbTypes.GeometryCollection:
+        return True
+    return not is_valid(geometry)
+
+
+def fix_geometry(geometry):
+    """Same as native:fixgeometries: when the repair collapses or gives another geometry type,
+    a null geometry is returned so the feature keeps its attributes without geometry.
+    Valid and null geometries are returned as they are, valid ones converted to multi type."""
+    if geometry.isNull():
+        return geometry
+    if geometry.isEmpty():
+        return QgsGeometry()
+
+    if not needs_repair(geometry):
+        geometry.convertToMultiType()
+        return geometry
+
+    fixed = geometry.makeValid() if MAKE_VALID_METHOD is None else geometry.makeValid(MAKE_VALID_METHOD)
+    if fixed.isNull() or fixed.isEmpty():
+        return QgsGeometry()
+
+    # makeValid can return a collection mixing polygons, lines and points, keep only the polygons
+    if QgsWkbTypes.flatType(fixed.wkbType()) == QgsWkbTypes.GeometryCollection:
+        parts = [part for part in fixed.asGeometryCollection() if part.type() == geometry.type()]
+        if not parts:
+            return QgsGeometry()
+        fixed = QgsGeometry.collectGeometry(parts)
+    elif fixed.type() != geometry.type():
+        # e.g. a polygon collapsed to a line
+        return QgsGeometry()
+
+    fixed.convertToMultiType()
+    return fixed
+
+
+def fix_layer(layer, feedback=None):
+    """In place native:fixgeometries for memory layers: only the invalid geometries are
+    repaired and written back, features with nothing valid left keep a null geometry.
+    Return the number of features changed."""
+    provider = layer.dataProvider()
+    single_type = not QgsWkbTypes.isMultiType(layer.wkbType())
+    changed_geometries = {}
+
+    request = QgsFeatureRequest().setNoAttributes()
+    for feature in layer.getFeatures(request):
+        if feedback and feedback.isCanceled():
+            break
+
+        geometry = feature.geometry()
+        # Features without geometry are kept as they are, like native:fixgeometries does
+        if geometry.isNull() or (not geometry.isEmpty() and not needs_repair(geometry)):
+            continue
+
+        fixed = fix_geometry(geometry)
+        if single_type and not fixed.isNull() and fixed.constGet().partCount() == 1:
+            fixed.convertToSingleType()
+        changed_geometries[feature.id()] = fixed
+
+    if changed_geometries:
+        provider.changeGeometryValues(changed_geometries)
+    layer.updateExtents()
+
+    return len(changed_geometries)
+
+
+def snap_to_grid(geometry):
+    return geometry.snappedToGrid(GRID_SPACING, GRID_SPACING)
+
+
+def buffer(geometry, distance):
+    buffered = geometry.buffer(distance, BUFFER_SEGMENTS, BUFFER_END_CAP_STYLE, BUFFER_JOIN_STYLE, BUFFER_MITER_LIMIT)
+    buffered.convertToMultiType()
+    return buffered
+
+
+def clean_geometry(geometry):
+    """Snap to grid, shrink, snap, grow back, snap and fix, removing the tiny spikes and
+    slivers left by overlays. Return a null geometry when nothing valid is left."""
+    geometry = snap_to_grid(geometry)
+    geometry = buffer(geometry, -BUFFER_DISTANCE)
+    geometry = snap_to_grid(geometry)
+    geometry = buffer(geometry, BUFFER_DISTANCE)
+    geometry = snap_to_grid(geometry)
+    return fix_geometry(geometry)
+
+
+def repair_wkb_chunk(step, wkbs):
+    """Entry point of the worker processes: apply the repair step ("fix" or "clean") to WKB
+    geometries and return WKB, or None for the null geometries, in the same order"""
+    repair = REPAIR_STEPS[step]
+    result = []
+    for wkb in wkbs:
+        geometry = QgsGeometry()
+        geometry.fromWkb(wkb)
+        repaired = repair(geometry)
+        result.append(None if repaired.isNull() else bytes(repaired.asWkb()))
+    return result
+
+
+REPAIR_STEPS = {
+    "fix": fix_geometry,
+    "clean": clean_geometry,
+}
@@ -1,20 +1,58 @@
+import hashlib
 import os
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (
     QgsProcessing,
     QgsFeatureSink,
     QgsFeatureRequest,
+    QgsGeometry,
+    QgsMemoryProviderUtils,
     QgsProcessingAlgorithm,
+    QgsProcessingException,
+    QgsProcessingParameterBoolean,
     QgsProcessingParameterCrs,
+    QgsProcessingParameterEnum,
+    QgsProcessingParameterExtent,
     QgsProcessingParameterField,
     QgsProcessingParameterNumber,
     QgsProcessingParameterFeatureSink,
     QgsProcessingParameterFeatureSource,
     QgsProcessingFeatureSourceDefinition,
+    QgsProcessingUtils,
+    QgsVectorFileWriter,
+    QgsWkbTypes,
 )
 
 from qgis import processing
 
+from pzp_utils.processing.parallel import chunks, process_pool, submit_in_order
+from pzp_utils.processing.partition import features_to_layer
+from pzp_utils.processing.repair import fix_layer
+
+# Results of the first dissolve of the last preview runs
+PREVIEW_CACHE_SIZE = 4
+_preview_cache = {}
+
+
+def native_generalize():
+    """The native engines need NumPy: the module is only imported when one of them runs, so the
+    provider still loads on a QGIS without NumPy"""
+    try:
+        from pzp_utils.processing import generalize
+    except ImportError as e:
+        raise QgsProcessingException(f"Il motore di generalizzazione nativo richiede NumPy ({e})")
+    return generalize
+
+
+def preview_key(features, parameters):
+    """Hash of the features and of the parameters of the first dissolve"""
+    digest = hashlib.blake2b(repr(parameters).encode(), digest_size=16)
+    for feature in features:
+        digest.update(feature.geometry().asWkb())
+        digest.update(repr(feature.attributes()).encode())
+    return digest.digest()
+
+
 class SimplifyIntensity(QgsProcessingAlgorithm):
     OUTPUT = 'OUTPUT'
     INPUT = 'INPUT'
@@ -23,8 +61,20 @@ class SimplifyIntensity(QgsProcessingAlgorithm):
     INTENSITY_FIELD = 'INTENSITY_FIELD'
     CHAIKEN_THRESHOLD = 'CHAIKEN_THRESHOLD'
     REDUCE_THRESHOLD = 'REDUCE_THRESHOLD'
+    GENERALIZE_ENGINE = 'GENERALIZE_ENGINE'
+    PREVIEW = 'PREVIEW'
+    PREVIEW_EXTENT = 'PREVIEW_EXTENT'
+    WORKERS = 'WORKERS'
     CRS = 'CRS'
 
+    ENGINE_NATIVE = 0
+    ENGINE_GRASS = 1
+    ENGINE_GRASS_SESSION = 2
+    ENGINE_TOPOLOGY = 3
+
+    # Features sent to a worker process at once
+    WORKER_CHUNK_SIZE = 200
+
     def __init__(self):
         super().__init__()
 
@@ -75,9 +125,35 @@ class SimplifyIntensity(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterNumber(
             self.REDUCE_THRESHOLD, "Reduce threshold", defaultValue = 20))
 
+        self.addParameter(QgsProcessingParameterEnum(
+            name=self.GENERALIZE_ENGINE,
+            description="Motore per la generalizzazione",
+            options=["Nativo, per anello (i confini condivisi possono non coincidere)",
+                     "GRASS (v.generalize)", "GRASS (v.generalize, sessione unica)",
+                     "Nativo, topologico (confini condivisi generalizzati una sola volta)"],
+            defaultValue = self.ENGINE_GRASS))
+
         self.addParameter(QgsProcessingParameterCrs(
             self.CRS, "CRS", defaultValue = "EPSG:2056"))
 
+        self.addParameter(QgsProcessingParameterBoolean(
+            name=self.PREVIEW,
+            description="Anteprima: riusa la prima dissoluzione se input e parametri non cambiano, "
+                        "per provare le soglie di generalizzazione",
+            defaultValue = False))
+
+        self.addParameter(QgsProcessingParameterExtent(
+            name=self.PREVIEW_EXTENT,
+            description="Estensione dell'anteprima",
+            optional=True))
+
+        self.addParameter(QgsProcessingParameterNumber(
+            name=self.WORKERS,
+            description="Numero di processi paralleli per la generalizzazione (solo motori nativi)",
+            type=QgsProcessingParameterNumber.Integer,
+            minValue=1,
+            defaultValue = 1))
+
         self.addParameter(QgsProcessingParameterFeatureSink(
             self.OUTPUT, "Output layer"))
 
@@ -88,12 +164,90 @@ class SimplifyIntensity(QgsProcessingAlgorithm):
         delete_holes_area = self.parameterAsInt(parameters, self.DELETE_HOLES_AREA, context)
         chaiken_threshold = self.parameterAsInt(parameters, self.CHAIKEN_THRESHOLD, context)
         reduce_threshold = self.parameterAsInt(parameters, self.REDUCE_THRESHOLD, context)
+        generalize_engine = self.parameterAsEnum(parameters, self.GENERALIZE_ENGINE, context)
         crs = self.parameterAsCrs(parameters, self.CRS, context)
+        preview = self.parameterAsBoolean(parameters, self.PREVIEW, context)
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
+
+        if preview:
+            result = self.cached_dissolve_intensity(
+                parameters, intensity_field, min_area_to_keep, delete_holes_area, crs, context, feedback)
+        else:
+            result = self.dissolve_intensity(
+                parameters[self.INPUT], intensity_field, min_area_to_keep, delete_holes_area, crs, context, feedback)
+
+        if generalize_engine == self.ENGINE_TOPOLOGY:
+            result = self.generalize_topology(
+                result['OUTPUT'], chaiken_threshold, reduce_threshold, workers, context, feedback)
+        elif generalize_engine == self.ENGINE_NATIVE:
+            result = self.generalize_native(
+                result['OUTPUT'], chaiken_threshold, reduce_threshold, workers, context, feedback)
+        elif generalize_engine == self.ENGINE_GRASS_SESSION:
+            result = self.generalize_grass_session(
+                result['OUTPUT'], chaiken_threshold, reduce_threshold, crs, context, feedback)
+        else:
+            result = self.generalize_grass(result['OUTPUT'], chaiken_threshold, reduce_threshold, context, feedback)
+
+        # Shared boundaries generalized once leave no gaps or overlaps to clean up
+        if generalize_engine != self.ENGINE_TOPOLOGY:
+            result = processing.run(
+                "native:fixgeometries",
+                {
+                    'INPUT': result['OUTPUT'],
+                    'OUTPUT': 'TEMPORARY_OUTPUT'
+                },
+                context=context,
+                feedback=feedback,
+                is_child_algorithm=True,
+            )
+
+            result = processing.run(
+                "native:dissolve",
+                {
+
+                    'INPUT': result['OUTPUT'],
+                    'FIELD': intensity_field,
+                    'SEPARATE_DISJOINT': True,
+                    'OUTPUT': 'memory:',
+                },
+                context=context,
+                feedback=feedback,
+                is_child_algorithm=True,
+            )
+
+            result = processing.run(
+                "native:extractbyexpression",
+                {
+                    'INPUT': result['OUTPUT'],
+                    'EXPRESSION': f'$area >= {min_area_to_keep}',
+                    'OUTPUT': 'memory:',
+                },
+                context=context,
+                feedback=feedback,
+                is_child_algorithm=True,
+            )
 
+        result = processing.run(
+            "native:deleteholes",
+            {
+                'INPUT': result['OUTPUT'],
+                'MIN_AREA': delete_holes_area,
+                'OUTPUT': parameters[self.OUTPUT],
+            },
+            context=context,
+            feedback=feedback,
+            is_child_algorithm=True,
+        )
+
+        return {self.OUTPUT: result['OUTPUT']}
+
+    def dissolve_intensity(self, input_layer, intensity_field, min_area_to_keep, delete_holes_area, crs, context,
+                           feedback):
+        """Dissolve by intensity, then remove the small polygons and holes"""
         result = processing.run(
             "native:assignprojection",
             {
-                'INPUT': parameters[self.INPUT],
+                'INPUT': input_layer,
                 'CRS': crs,
                 'OUTPUT': 'memory:',
             },
@@ -139,10 +293,112 @@ class SimplifyIntensity(QgsProcessingAlgorithm):
             is_child_algorithm=True,
         )
 
+        return result
+
+    def cached_dissolve_intensity(self, parameters, intensity_field, min_area_to_keep, delete_holes_area, crs, context,
+                                  feedback):
+        """Same as dissolve_intensity on the features in the preview extent (or the selected ones), reusing the
+        result of a previous run with the same features and parameters"""
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        request = QgsFeatureRequest()
+        extent = self.parameterAsExtent(parameters, self.PREVIEW_EXTENT, context, source.sourceCrs())
+        if not extent.isNull():
+            request.setFilterRect(extent)
+        features = list(source.getFeatures(request))
+
+        key = preview_key(features, (intensity_field, min_area_to_keep, delete_holes_area, crs.toWkt()))
+        cached = _preview_cache.get(key)
+        if cached is None:
+            result = self.dissolve_intensity(
+                features_to_layer(features, source.fields(), source.wkbType(), source.sourceCrs()),
+                intensity_field, min_area_to_keep, delete_holes_area, crs, context, feedback)
+            layer = QgsProcessingUtils.mapLayerFromString(result['OUTPUT'], context)
+            cached = (layer.fields(), layer.wkbType(), layer.crs(), list(layer.getFeatures()))
+
+            if len(_preview_cache) >= PREVIEW_CACHE_SIZE:
+                del _preview_cache[next(iter(_preview_cache))]
+            _preview_cache[key] = cached
+        else:
+            feedback.pushInfo("Anteprima: dissoluzione ed eliminazione dei buchi riprese dall'esecuzione precedente")
+
+        fields, wkb_type, layer_crs, dissolved_features = cached
+        layer = features_to_layer(dissolved_features, fields, wkb_type, layer_crs, 'dissolved')
+        context.temporaryLayerStore().addMapLayer(layer)
+        return {'OUTPUT': layer.id()}
+
+    def generalize_native(self, input_layer, chaiken_threshold, reduce_threshold, workers, context, feedback):
+        """Chaiken smoothing and reduction in process, without starting GRASS. Every ring is generalized
+        on its own, so the two sides of a border shared by two classes can end up different.
+        With more than one worker, chunks of features are generalized on a pool of worker processes."""
+        generalize = native_generalize()
+        layer = QgsProcessingUtils.mapLayerFromString(input_layer, context)
+        output_layer = QgsMemoryProviderUtils.createMemoryLayer(
+            'generalized', layer.fields(), QgsWkbTypes.multiType(layer.wkbType()), layer.crs())
+
+        features = []
+        if workers <= 1:
+            for feature in layer.getFeatures():
+                if feedback.isCanceled():
+                    break
+
+                geometry = generalize.generalize_geometry(feature.geometry(), chaiken_threshold, reduce_threshold)
+                if geometry is None:
+                    continue
+                feature.setGeometry(geometry)
+                features.append(feature)
+        else:
+            # Every geometry is generalized on its own, so the layer is simply cut in chunks
+            tasks = (
+                (chunk, ([bytes(feature.geometry().asWkb()) for feature in chunk], chaiken_threshold, reduce_threshold))
+                for chunk in chunks(layer.getFeatures(), self.WORKER_CHUNK_SIZE)
+            )
+            with process_pool(workers) as pool:
+                for chunk, wkbs in submit_in_order(pool, generalize.generalize_wkb_chunk, tasks, 2 * workers):
+                    if feedback.isCanceled():
+                        break
+
+                    for feature, wkb in zip(chunk, wkbs):
+                        if wkb is None:
+                            continue
+                        geometry = QgsGeometry()
+                        geometry.fromWkb(wkb)
+                        feature.setGeometry(geometry)
+                        features.append(feature)
+        output_layer.dataProvider().addFeatures(features, QgsFeatureSink.FastInsert)
+
+        context.temporaryLayerStore().addMapLayer(output_layer)
+        return {'OUTPUT': output_layer.id()}
+
+    def generalize_topology(self, input_layer, chaiken_threshold, reduce_threshold, workers, context, feedback):
+        """Chaiken smoothing and reduction of the shared boundaries, each one generalized once"""
+        layer = QgsProcessingUtils.mapLayerFromString(input_layer, context)
+        output_layer = QgsMemoryProviderUtils.createMemoryLayer(
+            'generalized', layer.fields(), QgsWkbTypes.multiType(layer.wkbType()), layer.crs())
+
+        # The whole layer is needed to find the boundaries shared by the polygons
+        features = [feature for feature in layer.getFeatures() if feature.hasGeometry()]
+        geometries = native_generalize().generalize_topology(
+            [feature.geometry() for feature in features], chaiken_threshold, reduce_threshold, workers)
+
+        generalized_features = []
+        for feature, geometry in zip(features, geometries):
+            if geometry is None:
+                continue
+            feature.setGeometry(geometry)
+            generalized_features.append(feature)
+        output_layer.dataProvider().addFeatures(generalized_features, QgsFeatureSink.FastInsert)
+
+        # Smoothing can still make a narrow polygon cross itself, only those are repaired
+        fix_layer(output_layer, feedback)
+
+        context.temporaryLayerStore().addMapLayer(output_layer)
+        return {'OUTPUT': output_layer.id()}
+
+    def generalize_grass(self, input_layer, chaiken_threshold, reduce_threshold, context, feedback):
         result = processing.run(
             "grass7:v.generalize",
             {
-                'input': result['OUTPUT'],
+                'input': input_layer,
                 'type': [0,1,2],
                 'cats': '',
                 'where': '',
@@ -215,36 +471,56 @@ class SimplifyIntensity(QgsProcessingAlgorithm):
         )
         result['OUTPUT'] = result['output']
 
-        result = processing.run(
-            "native:fixgeometries",
-            {
-                'INPUT': result['OUTPUT'],
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            },
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+        return result
+
+    def generalize_grass_session(self, input_layer, chaiken_threshold, reduce_threshold, crs, context, feedback):
+        """Same as generalize_grass, but both v.generalize passes run in a single GRASS session,
+        so the layer is imported and exported only once"""
+        try:
+            from grassprovider.Grass7Utils import Grass7Utils
+        except ImportError:
+            # Grass7Utils has been renamed GrassUtils in QGIS 3.36
+            from grassprovider.grass_utils import GrassUtils as Grass7Utils
+
+        # v.in.ogr reads the layer from a file
+        input_path = QgsProcessingUtils.generateTempFilename('intensity.gpkg')
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = 'GPKG'
+        QgsVectorFileWriter.writeAsVectorFormatV2(
+            QgsProcessingUtils.mapLayerFromString(input_layer, context), input_path,
+            context.transformContext(), options)
+
+        output_path = QgsProcessingUtils.generateTempFilename('generalized.gpkg')
+        generalize = (
+            'v.generalize input={input} output={output} type=line,boundary,area method={method} '
+            'threshold={threshold} look_ahead=7 reduction=1 slide=0.5 angle_thresh=3 degree_thresh=0 '
+            'closeness_thresh=0 betweeness_thresh=0 alpha=1 beta=1 iterations=1 --overwrite'
         )
-
-        result = processing.run(
-            "native:dissolve",
-            {
-
-                'INPUT': result['OUTPUT'],
-                'FIELD': intensity_field,
-                'SEPARATE_DISJOINT': True,
-                'OUTPUT': 'memory:',
-            },
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
-
+        commands = [
+            f'v.in.ogr min_area=0.0001 snap=-1 input="{input_path}" output=intensity --overwrite -o',
+            generalize.format(input='intensity', output='chaiken', method='chaiken', threshold=chaiken_threshold),
+            generalize.format(input='chaiken', output='reduced', method='reduction', threshold=reduce_threshold),
+        ]
+        output_commands = [
+            f'v.out.ogr type=auto input=reduced output="{output_path}" format=GPKG output_layer=generalized --overwrite',
+        ]
+
+        # Reuse the session if one has been started outside of this algorithm
+        existing_session = Grass7Utils.sessionRunning
+        if not existing_session:
+            Grass7Utils.startGrassSession()
+        try:
+            Grass7Utils.executeGrass(commands, feedback, output_commands)
+        finally:
+            if not existing_session:
+                Grass7Utils.endGrassSession()
+
+        # The temporary GRASS location has no projection
         result = processing.run(
-            "native:extractbyexpression",
+            "native:assignprojection",
             {
-                'INPUT': result['OUTPUT'],
-                'EXPRESSION': f'$area >= {min_area_to_keep}',
+                'INPUT': output_path,
+                'CRS': crs,
                 'OUTPUT': 'memory:',
             },
             context=context,
@@ -252,16 +528,4 @@ class SimplifyIntensity(QgsProcessingAlgorithm):
             is_child_algorithm=True,
         )
 
-        result = processing.run(
-            "native:deleteholes",
-            {
-                'INPUT': result['OUTPUT'],
-                'MIN_AREA': delete_holes_area,
-                'OUTPUT': parameters[self.OUTPUT],
-            },
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
-
-        return {self.OUTPUT: result['OUTPUT']}
+        return result
@@ -0,0 +1,36 @@
+from qgis.core import QgsFeatureSink
+
+
+class ChunkedSinkWriter:
+    """Write features to a sink in chunks of chunk_size, so at most one chunk is kept in memory.
+
+    Progress is reported and cancellation checked once per chunk."""
+
+    def __init__(self, sink, chunk_size, feedback, total=0):
+        self.sink = sink
+        self.chunk_size = max(1, chunk_size)
+        self.feedback = feedback
+        self.total = total
+        self.written = 0
+        self.chunk = []
+
+    def addFeature(self, feature):
+        """Return False when the algorithm has been canceled"""
+        self.chunk.append(feature)
+        if len(self.chunk) >= self.chunk_size:
+            return self.flush()
+        return True
+
+    def flush(self):
+        if self.feedback.isCanceled():
+            self.chunk = []
+            return False
+
+        if self.chunk:
+            self.sink.addFeatures(self.chunk, QgsFeatureSink.FastInsert)
+            self.written += len(self.chunk)
+            self.chunk = []
+
+        if self.total > 0:
+            self.feedback.setProgress(100.0 * self.written / self.total)
+        return True